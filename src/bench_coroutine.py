@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Pierre-André Saulais <pasaulais@free.fr>
+#
+# This file is part of the Spark File-transfer Tool.
+#
+# Spark is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Spark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spark; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+""" Measure how fast coroutines are resumed by Future.run_coroutine, e.g. when they yield futures which are already done. """
+
+import sys
+import time
+from spark.core.tasks import Future, coroutine
+
+@coroutine
+def yield_done(count):
+    """ Yield futures which are already completed, which resumes the coroutine immediately. """
+    total = 0
+    for i in xrange(count):
+        total += yield Future.done(i)
+    yield total
+
+@coroutine
+def yield_pending(futures):
+    """ Yield futures which are completed later, by the caller. """
+    total = 0
+    for f in futures:
+        total += yield f
+    yield total
+
+def run_bench(name, count, fun):
+    started = time.time()
+    result = fun(count)
+    duration = time.time() - started
+    assert result == count * (count - 1) / 2
+    print "[%s] %d futures in %.2fs, %d resumes/s" % (name, count, duration, count / duration)
+
+def bench_pending(count):
+    futures = [Future() for i in xrange(count)]
+    f = yield_pending(futures)
+    for i, pending in enumerate(futures):
+        pending.completed(i)
+    return f.result
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    print "recursion limit: %d" % sys.getrecursionlimit()
+    run_bench("done", count, lambda n: yield_done(n).result)
+    run_bench("pending", count, bench_pending)
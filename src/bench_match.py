@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Pierre-André Saulais <pasaulais@free.fr>
+#
+# This file is part of the Spark File-transfer Tool.
+#
+# Spark is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Spark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spark; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+""" Measure how fast messages can be matched against patterns, with match() and compiled patterns. """
+
+import sys
+import time
+from spark.core.process import Command, Event, match, compile_pattern, PatternMatcher
+from spark.messaging.messages import Request, Response, Notification, Block
+
+# (pattern, message) pairs similar to those found in the messenger, the session and the transfers
+CASES = [
+    ("send-block", Command("send", None, int), Command("send", Block(1, 42, "x" * 4096), 12)),
+    ("block-route", Block, Block(1, 42, "x" * 4096)),
+    ("request", Request("list-files", None), Request("list-files", {}).withID(3)),
+    ("response", Response("create-transfer", int, int, int), Response("create-transfer", 4, 1, 4096).withID(7)),
+    ("notification", Notification("transfer-state-changed", int, basestring),
+        Notification("transfer-state-changed", 1, "finished").withID(9)),
+    ("event-mismatch", Event("protocol-negociated", basestring), Event("remote-state-changed", "active")),
+    ("tuple-mismatch", Command("send", None, int), Command("close-transfer")),
+]
+
+def run_case(name, pattern, m, count):
+    compiled = compile_pattern(pattern)
+    assert compiled(m) == match(pattern, m)
+    started = time.time()
+    for i in xrange(count):
+        match(pattern, m)
+    interpreted = time.time() - started
+    started = time.time()
+    for i in xrange(count):
+        compiled(m)
+    duration = time.time() - started
+    print "[%s] match: %d/s, compiled: %d/s (x%.1f)" % (
+        name, count / interpreted, count / duration, interpreted / duration)
+
+def run_dispatch(count):
+    """ Dispatch messages through a matcher with as many patterns as a file-sharing session. """
+    matcher = PatternMatcher()
+    for i in range(30):
+        matcher.addPattern(Request("request-%d" % i, None))
+        matcher.addPattern(Command("command-%d" % i, int))
+    matcher.addPattern(Event(basestring, None))
+    messages = [Request("request-%d" % (i % 30), {}).withID(i) for i in range(100)]
+    started = time.time()
+    for i in xrange(count / 100):
+        for m in messages:
+            matcher.match(m)
+    duration = time.time() - started
+    print "[dispatch] %d messages/s with %d patterns" % (count / duration, len(matcher.patterns))
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, pattern, m in CASES:
+        run_case(name, pattern, m, count)
+    run_dispatch(count)
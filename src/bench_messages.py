@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Pierre-André Saulais <pasaulais@free.fr>
+#
+# This file is part of the Spark File-transfer Tool.
+#
+# Spark is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Spark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spark; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+""" Measure the memory used by messages and how fast they can be created and sliced. """
+
+import sys
+import time
+from collections import Sequence
+from spark.core.process import Command
+from spark.messaging.messages import Request, Block
+
+class DictCommand(Sequence):
+    """ Reference implementation: the previous ProcessMessage, which stores its items in a __dict__. """
+    def __init__(self, name, *params):
+        self.type = "Command"
+        self.name = name
+        self.params = params
+    
+    def __len__(self):
+        return 2 + len(self.params)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self)[index]
+        elif index == 0:
+            return self.type
+        elif index == 1:
+            return self.name
+        elif (index > 1) and (index < (len(self.params) + 2)):
+            return self.params[index - 2]
+        else:
+            raise IndexError("Index '%i' out of range" % index)
+
+def message_parts(m):
+    """ Return the objects allocated for a message: itself, its __dict__ and the tuples it owns. """
+    parts = [m]
+    if hasattr(m, "__dict__"):
+        parts.append(m.__dict__)
+        parts.extend(v for v in m.__dict__.values() if type(v) is tuple)
+    if hasattr(m, "_items"):
+        parts.append(m._items)
+    return parts
+
+def run_bench(name, create, count):
+    started = time.time()
+    messages = [create(i) for i in xrange(count)]
+    created = time.time() - started
+    parts = message_parts(messages[0])
+    size = sum(sys.getsizeof(part) for part in parts)
+    started = time.time()
+    for m in messages:
+        m[2:]
+    sliced = time.time() - started
+    print "[%s] %d objects/message, %d bytes/message, %d created/s, %d slices/s" % (
+        name, len(parts), size, count / created, count / sliced)
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    data = "x" * 4096
+    run_bench("dict-command", lambda i: DictCommand("send", data, i), count)
+    run_bench("command", lambda i: Command("send", data, i), count)
+    run_bench("request", lambda i: Request("create-transfer", i, 4096).withID(i), count)
+    run_bench("block", lambda i: Block(1, i, data), count)
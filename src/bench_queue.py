@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Pierre-André Saulais <pasaulais@free.fr>
+#
+# This file is part of the Spark File-transfer Tool.
+#
+# Spark is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Spark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spark; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+""" Measure the throughput of BlockingQueue with several producers and consumers. """
+
+import sys
+import time
+import threading
+from spark.core.queue import BlockingQueue, QueueClosedError
+
+class ListQueue(object):
+    """ Reference implementation: list-backed queue with a single condition. """
+    def __init__(self, size):
+        self.lock = threading.Lock()
+        self.wait = threading.Condition(self.lock)
+        self.size = size
+        self.list = []
+        self.closed = False
+    
+    def put(self, item):
+        with self.lock:
+            while len(self.list) == self.size:
+                self.wait.wait()
+            self.list.append(item)
+            self.wait.notifyAll()
+    
+    def get(self):
+        with self.lock:
+            while not self.list:
+                if self.closed:
+                    raise QueueClosedError()
+                self.wait.wait()
+            item = self.list.pop(0)
+            self.wait.notifyAll()
+            return item
+    
+    def __iter__(self):
+        while True:
+            try:
+                yield self.get()
+            except QueueClosedError:
+                return
+    
+    def close(self, waitEmpty=False):
+        with self.lock:
+            self.closed = True
+            self.wait.notifyAll()
+
+def run_bench(factory, producers, consumers, count, size, repeat=5):
+    """ Run the benchmark several times and report the fastest run, to smooth out scheduling noise. """
+    duration = min(run_once(factory, producers, consumers, count, size) for i in range(repeat))
+    total = producers * count
+    print "[%s] %d producers, %d consumers: %d items in %f seconds (%d items/s)" % (
+        factory.__name__, producers, consumers, total, duration, total / duration)
+
+def run_once(factory, producers, consumers, count, size):
+    queue = factory(size)
+    def produce():
+        for i in xrange(count):
+            queue.put(i)
+    def consume():
+        for item in queue:
+            pass
+    threads = [threading.Thread(target=consume) for i in range(consumers)]
+    senders = [threading.Thread(target=produce) for i in range(producers)]
+    started = time.time()
+    for t in threads + senders:
+        t.start()
+    for t in senders:
+        t.join()
+    queue.close(True)
+    for t in threads:
+        t.join()
+    return time.time() - started
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for size in (64, 4096):
+        print "Queue size: %d" % size
+        for producers, consumers in [(1, 1), (4, 1), (4, 4), (8, 2)]:
+            for factory in (ListQueue, BlockingQueue):
+                run_bench(factory, producers, consumers, count, size)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Pierre-André Saulais <pasaulais@free.fr>
+#
+# This file is part of the Spark File-transfer Tool.
+#
+# Spark is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Spark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spark; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+""" Measure how many messages per second a process can send to another one. """
+
+import sys
+import time
+from spark.core.process import Process, ProcessExited, ProcessKilled
+from spark.core.queue import QueueClosedError
+
+def uncached_send(pid, m):
+    """ Reference implementation: look the queue up with the registry lock held for every message. """
+    if not Process._current.p.queue.isOpen:
+        raise ProcessKilled()
+    pid = Process._to_pid(pid)
+    with Process._lock:
+        queue = Process._processes[pid].queue
+    try:
+        queue.put(m)
+    except QueueClosedError:
+        raise ProcessExited("Can't send a message to a stopped process (PID: %i)" % pid)
+
+def receiver(senderPid, count):
+    for i in xrange(count):
+        Process.receive()
+    Process.send(senderPid, "done")
+
+def run_bench(send, count):
+    pid = Process.spawn(receiver, (Process.current(), count), "Receiver")
+    started = time.time()
+    for i in xrange(count):
+        send(pid, i)
+    Process.receive()
+    duration = time.time() - started
+    print "[%s] sent %d messages in %f seconds (%d messages/s)" % (
+        send.__name__, count, duration, count / duration)
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    Process.attach("Sender")
+    try:
+        for send in (uncached_send, Process.send):
+            run_bench(send, count)
+    finally:
+        Process.detach()
@@ -22,10 +22,15 @@
 from spark.core.tasks import *
 from spark.core.queue import *
 from spark.core.debugger import *
+from spark.core.scheduler import *
+from spark.core.profiler import *
 from spark.core.process import *
+from spark.core.simulation import *
+from spark.core.offload import *
+from spark.core.aio import *
 from spark.core.io import *
 from spark.core.secureio import *
 
 __all__ = []
-for module in (tasks, queue, debugger, process, io, secureio):
+for module in (tasks, queue, debugger, scheduler, profiler, process, simulation, offload, aio, io, secureio):
     __all__.extend(module.__all__)
\ No newline at end of file
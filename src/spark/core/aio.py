@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Pierre-André Saulais <pasaulais@free.fr>
+#
+# This file is part of the Spark File-transfer Tool.
+#
+# Spark is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Spark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spark; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Run processes and futures on an asyncio event loop. This uses asyncio if it is available,
+otherwise its backport trollius. If neither is installed, using the module raises an exception.
+"""
+
+import sys
+from collections import deque
+from spark.core.tasks import Future, WaitTimeoutError
+from spark.core.queue import QueueClosedError
+from spark.core.process import Process, ProcessExited, CONTROL_LANE
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+__all__ = ["AsyncioPool", "to_asyncio", "from_asyncio"]
+
+def _checkAsyncio():
+    if asyncio is None:
+        raise ImportError("Neither asyncio nor trollius is available")
+
+def to_asyncio(future, loop=None):
+    """
+    Return an asyncio future which gets the result of the future, on the loop's thread.
+    Canceling the asyncio future cancels the future.
+    """
+    _checkAsyncio()
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    converted = asyncio.Future(loop=loop)
+    def cancelled(converted):
+        if converted.cancelled() and future.pending:
+            future._tryCancel()
+    converted.add_done_callback(cancelled)
+    future.after(lambda f: loop.call_soon_threadsafe(_setAsyncioResult, f, converted))
+    return converted
+
+def _setAsyncioResult(f, converted):
+    if converted.done():
+        return
+    try:
+        result = f.result
+    except Exception:
+        converted.set_exception(sys.exc_info()[1])
+    else:
+        converted.set_result(result)
+
+def from_asyncio(converted):
+    """ Return a future which gets the result of the asyncio future (on the loop's thread). """
+    _checkAsyncio()
+    future = Future()
+    def done(converted):
+        if converted.cancelled():
+            future._tryCancel()
+        elif converted.exception() is not None:
+            future._tryAssign(False, converted.exception())
+        else:
+            future._tryAssign(True, converted.result())
+    converted.add_done_callback(done)
+    return future
+
+class AsyncioPool(object):
+    """
+    Worker pool which runs processes as callbacks of an asyncio event loop instead of on threads,
+    e.g. by setting Process.defaultPool or ProcessBase.pool. Processes which need a dedicated
+    thread (e.g. TcpMessenger) still get one. Processes running on the loop must not block it:
+    Process.send() parks the messages which don't fit in the queue instead of waiting (unless
+    it is given a timeout), and callbacks of the loop which aren't processes can use send().
+    """
+    # how long (in seconds) to wait before trying again to send messages to a full queue
+    retryDelay = 0.01
+    
+    def __init__(self, loop=None):
+        _checkAsyncio()
+        self.loop = loop or asyncio.get_event_loop()
+        # messages waiting for room in a queue, by (pid, lane)
+        self.backlog = {}
+        self.closed = False
+    
+    def submit(self, fun, *args):
+        """ Queue the callable to be executed by the loop. This can be called from any thread. """
+        if self.closed:
+            raise Exception("The pool has been shut down")
+        self.loop.call_soon_threadsafe(fun, *args)
+    
+    def shutdown(self, wait=True):
+        """ Stop accepting callables and forget the messages which have not been sent yet. """
+        self.closed = True
+        self.backlog.clear()
+    
+    def send(self, pid, m, lane=None):
+        """
+        Send a message from the loop's thread without blocking it. If the process' queue is full
+        the message is sent later, after the messages which were already waiting.
+        """
+        pid = Process._to_pid(pid)
+        if lane is None:
+            lane = getattr(m, "lane", CONTROL_LANE)
+        key = (pid, lane)
+        backlog = self.backlog.get(key)
+        if backlog is not None:
+            backlog.append(m)
+            return
+        try:
+            Process._getQueue(pid).put(m, lane, 0)
+        except WaitTimeoutError:
+            self.backlog[key] = deque([m])
+            self.loop.call_later(self.retryDelay, self._sendBacklog, key)
+        except QueueClosedError:
+            raise ProcessExited("Can't send a message to a stopped process (PID: %i)" % pid)
+    
+    def _sendBacklog(self, key):
+        backlog = self.backlog.get(key)
+        if backlog is None:
+            return
+        pid, lane = key
+        try:
+            queue = Process._getQueue(pid)
+            while backlog:
+                queue.put(backlog[0], lane, 0)
+                backlog.popleft()
+        except WaitTimeoutError:
+            self.loop.call_later(self.retryDelay, self._sendBacklog, key)
+            return
+        except Exception:
+            # the process exited, the messages are lost like with Process.try_send()
+            pass
+        del self.backlog[key]
@@ -83,6 +83,23 @@ def _handle_command(line, log):
         launch_local()
     elif line == "rpdb":
         launch_remote()
+    elif line == "stats":
+        _dump_stats(log)
+    elif line in ("stats on", "stats off"):
+        Process.track_stats(line == "stats on")
+    elif line == "profile":
+        _dump_profile(log)
+    elif re.match("^profile on( [1-9]\d*)?$", line):
+        from spark.core.process import PatternMatcher
+        from spark.core.profiler import HandlerProfiler
+        chunks = line.split(" ")
+        sampleEvery = int(chunks[2]) if len(chunks) > 2 else 1
+        PatternMatcher.profiler = HandlerProfiler(sampleEvery)
+    elif line == "profile off":
+        from spark.core.process import PatternMatcher
+        PatternMatcher.profiler = None
+    elif re.match("^profile-json .+$", line):
+        _save_profile(line.split(" ", 1)[1], log)
     elif line == "term":
         os.kill(os.getpid(), signal.SIGTERM)
     elif line == "kill":
@@ -102,6 +119,36 @@ def _handle_command(line, log):
     else:
         log.error("Unknown command %s", repr(line))
 
+def _dump_stats(log):
+    for pid in sorted(Process.all()):
+        try:
+            stats = Process.stats(pid)
+        except Exception:
+            continue
+        if stats is None:
+            continue
+        latency = ", ".join("%s: %d" % ("<%gs" % bound if bound else "more", count)
+            for bound, count in stats["latency"] if count)
+        log.info("Queue of %s: depth %d, high-water %d, in %d, out %d, blocked in put %.3fs, latency {%s}",
+            stats["name"], stats["depth"], stats["highWater"], stats["in"], stats["out"],
+            stats["putBlockedTime"], latency)
+
+def _dump_profile(log):
+    from spark.core.process import PatternMatcher
+    if PatternMatcher.profiler is None:
+        log.error("The profiler is not enabled, use 'profile on [sample-every]' first")
+    else:
+        PatternMatcher.profiler.dump(log)
+
+def _save_profile(path, log):
+    from spark.core.process import PatternMatcher
+    if PatternMatcher.profiler is None:
+        log.error("The profiler is not enabled, use 'profile on [sample-every]' first")
+    else:
+        with open(path, "w") as f:
+            f.write(PatternMatcher.profiler.to_json())
+        log.info("Saved the handler profile to %s.", repr(path))
+
 def _dump_threads(log):
     currentID = threading.current_thread().ident
     for threadID, frame in sys._current_frames().items():
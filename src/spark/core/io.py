@@ -210,6 +210,9 @@ class TcpSocket(ProcessBase):
             logger.exception("Closing the socket failed.")
 
 class TcpReceiver(ProcessBase):
+    # accept(), connect() and recv() block
+    dedicatedThread = True
+    
     def __init__(self, name=None):
         super(TcpReceiver, self).__init__(name)
     
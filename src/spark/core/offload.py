@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Pierre-André Saulais <pasaulais@free.fr>
+#
+# This file is part of the Spark File-transfer Tool.
+#
+# Spark is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Spark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spark; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+""" Worker processes (of the operating system) which run CPU-bound tasks outside of the interpreter's lock. """
+
+import sys
+import logging
+import threading
+import cPickle
+import multiprocessing
+from collections import deque
+from spark.core.tasks import Future, TaskCanceledError, WaitTimeoutError
+from spark.core.queue import BlockingQueue, QueueClosedError
+from spark.core.process import Process, Event
+
+__all__ = ["OffloadPool"]
+
+def _invokeRemote(fun, args):
+    """ Call the function in a worker process. Return (True, result) or (False, exception). """
+    try:
+        return (True, fun(*args))
+    except Exception:
+        e = sys.exc_info()[1]
+        try:
+            cPickle.dumps(e, -1)
+        except Exception:
+            e = Exception("%s: %s" % (e.__class__.__name__, e))
+        return (False, e)
+
+class OffloadPool(object):
+    """
+    Pool of worker processes executing callables, which returns a Future for every callable.
+    At most size callables run at the same time, the other ones wait in the order they were
+    submitted. A callable can be canceled by canceling its future until it starts to run.
+    Callables, arguments and results are pickled, so the callables have to be defined at
+    the top level of a module.
+    
+    Futures are completed by a thread of the pool which is attached to a process, so their
+    continuations can send messages but should not block.
+    
+    The worker processes are forked when the pool is created. Forking while other threads
+    are running can deadlock the workers on locks those threads held (e.g. logging's), so
+    the pool should be created before starting any thread or process.
+    """
+    # how often (in seconds) to look for tasks that the worker processes failed to run
+    pollInterval = 1.0
+    
+    def __init__(self, size=None, name="offload"):
+        self.size = size or multiprocessing.cpu_count()
+        self.name = name
+        self.__lock = threading.Lock()
+        self.__waiting = deque()
+        # future -> (task, AsyncResult) of the tasks given to the worker processes
+        self.__running = {}
+        self.__results = BlockingQueue(None)
+        self.__closed = False
+        self.__pool = multiprocessing.Pool(self.size)
+        self.__dispatcher = threading.Thread(target=self.__dispatch, name=self.name)
+        self.__dispatcher.daemon = True
+        self.__dispatcher.start()
+    
+    def submit(self, fun, *args):
+        """ Queue the callable to be executed by a worker process and return a Future. """
+        future = Future()
+        self.__submit((future, fun, args, None))
+        return future
+    
+    def submit_event(self, name, fun, *args):
+        """
+        Like submit(), but once the callable returns or raises Event(name, future) is also sent
+        to the current process, so that the result is handled like any other message.
+        The event is dropped if the queue of the process is full at that time.
+        """
+        pid = Process.current()
+        if not pid:
+            raise Exception("The current thread has no PID")
+        future = Future()
+        self.__submit((future, fun, args, (pid, name)))
+        return future
+    
+    @property
+    def pending(self):
+        """ Return the number of callables which are running or waiting to run. """
+        with self.__lock:
+            return len(self.__running) + len(self.__waiting)
+    
+    def shutdown(self, wait=True):
+        """
+        Stop the worker processes. Callables which haven't started are canceled. If wait is true,
+        wait for the running ones to finish, otherwise their worker processes are terminated.
+        """
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            waiting = list(self.__waiting)
+            self.__waiting.clear()
+            pool, dispatcher = self.__pool, self.__dispatcher
+        for task in waiting:
+            self.__cancel(task[0])
+        if wait:
+            pool.close()
+            pool.join()
+        else:
+            pool.terminate()
+            with self.__lock:
+                running = list(self.__running)
+                self.__running.clear()
+            for future in running:
+                self.__cancel(future)
+        self.__results.close(True)
+        if dispatcher is not threading.current_thread():
+            dispatcher.join()
+    
+    def __submit(self, task):
+        with self.__lock:
+            if self.__closed:
+                raise Exception("The pool has been shut down")
+            if len(self.__running) < self.size:
+                self.__apply(task)
+            else:
+                self.__waiting.append(task)
+    
+    def __apply(self, task):
+        """ Give the task to the worker processes. The lock must be held. """
+        future, fun, args, notify = task
+        self.__running[future] = (task, self.__pool.apply_async(_invokeRemote, (fun, args),
+            callback=lambda result: self.__results.put((task, result))))
+    
+    def __dispatch(self):
+        Process.attach(self.name)
+        try:
+            while True:
+                try:
+                    task, result = self.__results.get(self.pollInterval)
+                except WaitTimeoutError:
+                    self.__checkFailed()
+                except QueueClosedError:
+                    break
+                else:
+                    self.__taskDone(task, result)
+        finally:
+            Process.detach()
+    
+    def __checkFailed(self):
+        """ Fail the tasks the worker processes could not run (e.g. the arguments can't be pickled). """
+        with self.__lock:
+            failed = [(task, r) for task, r in self.__running.itervalues()
+                      if r.ready() and not r.successful()]
+        for task, r in failed:
+            try:
+                r.get()
+            except Exception:
+                self.__taskDone(task, (False, sys.exc_info()[1]))
+    
+    def __taskDone(self, task, result):
+        with self.__lock:
+            if self.__running.pop(task[0], None) is None:
+                return
+            # start the next callable which wasn't canceled
+            while self.__waiting and not self.__closed:
+                next = self.__waiting.popleft()
+                if next[0].pending:
+                    self.__apply(next)
+                    break
+        future, fun, args, notify = task
+        success, value = result
+        try:
+            if success:
+                future.completed(value)
+            else:
+                future.failed(value)
+        except TaskCanceledError:
+            # the future was canceled while the callable was running
+            return
+        except Exception:
+            logging.exception("An exception was raised by a continuation of the pool '%s'", self.name)
+        if notify is not None:
+            pid, name = notify
+            # waiting for room in a full queue would hold up the results of the other callables
+            if not Process.try_send(pid, Event(name, future), timeout=0):
+                logging.warning("The pool '%s' dropped the event '%s' for process %s, whose queue is full or closed",
+                                self.name, name, repr(pid))
+    
+    def __cancel(self, future):
+        if future.pending:
+            try:
+                future.cancel()
+            except Exception:
+                pass
@@ -20,14 +20,21 @@
 
 """ Interface that allows the use of Erlang-like processes that can send messages to each other. """
 
-from collections import Sequence, Mapping
+from collections import Sequence, Mapping, OrderedDict, deque
 import threading
+import time
 import logging
 from spark.core.queue import BlockingQueue, QueueClosedError
+from spark.core.tasks import WaitTimeoutError, _timers
 from spark.core import debugger
 
-__all__ = ["Process", "ProcessState", "ProcessBase", "ProcessExit", "ProcessExited", "ProcessKilled",
-           "ProcessNotifier", "Command", "Event", "EventSender", "match", "PatternMatcher"]
+__all__ = ["CONTROL_LANE", "BULK_LANE", "Process", "ProcessState", "ProcessBase", "ProcessExit", "ProcessExited", "ProcessKilled",
+           "ProcessNotifier", "Command", "Event", "EventSender", "match", "compile_pattern", "payload_size", "PatternMatcher"]
+
+# lanes of a process' queue. Messages in the control lane are received before bulk messages
+# Messages can choose their lane by having a 'lane' attribute, otherwise they use the control lane
+CONTROL_LANE = 0
+BULK_LANE = 1
 
 class Process(object):
     """ A process can execute callables and communicate using messages. """
@@ -35,16 +42,55 @@ class Process(object):
     _processes = {}
     _nextID = 1
     _current = threading.local()
+    # worker pool used by ProcessBase instances which don't need a dedicated thread
+    # if None, every process has its own thread
+    defaultPool = None
+    # maximum number of queues a process keeps in its cache (see send())
+    queueCacheSize = 256
+    # whether the queues of new processes keep track of statistics (see stats())
+    statsEnabled = False
+    # maximum number of messages in every lane of a process' queue, None for unbounded queues
+    queueSize = 64
+    # maximum payload size (in bytes, see payload_size) of the messages in every lane, None for no limit
+    queueBytes = None
+    # if False, the sizes given when spawning processes are ignored and their queues are unbounded
+    boundedQueues = True
+    # how long (in seconds) to wait before trying again to send the messages a process running
+    # on a worker pool couldn't send because the queue was full (see send())
+    retryDelay = 0.01
     
-    def __init__(self, pid, name):
+    def __init__(self, pid, name, queueSize=None, queueBytes=None):
         self.pid = pid
         self.name = name
-        self.queue = BlockingQueue(64)
+        if not Process.boundedQueues:
+            queueSize = queueBytes = None
+        else:
+            if queueSize is None:
+                queueSize = Process.queueSize
+            if queueBytes is None:
+                queueBytes = Process.queueBytes
+        self.queue = BlockingQueue(queueSize, lanes=2, stats=Process.statsEnabled,
+                                   byteBudget=queueBytes, weigh=payload_size)
         self.thread = None
         self.state = None
         self.logger = None
         self.linked = set()
         self.trapExit = False
+        # queues of the processes this process sent messages to
+        self.queueCache = {}
+        # messages skipped by a selective receive (see receive()), created when needed
+        self.saved = None
+        # used when the process runs on a worker pool instead of its own thread
+        self.actor = None
+        self.pool = None
+        self.runLock = None
+        self.scheduled = False
+        self.running = False
+        self.notified = False
+        self.exited = False
+        # messages that couldn't be sent yet without blocking the worker thread, by (pid, lane)
+        self.parked = None
+        self.parkLock = None
     
     def displayName(self):
         if self.name:
@@ -54,9 +100,9 @@ class Process(object):
 
     @classmethod
     def all(cls):
-        """ Enumerates the IDs of all processes. """
+        """ Return the IDs of all running processes. """
         with cls._lock:
-            return cls._processes.iter_keys()
+            return cls._processes.keys()
     
     @classmethod
     def current(cls):
@@ -72,7 +118,9 @@ class Process(object):
         if hasattr(cls._current, "p"):
             p = cls._current.p
             if p.logger is None:
-                p.logger = logging.getLogger(p.displayName())
+                # getLogger() would keep a logger for every process that ever ran
+                p.logger = logging.Logger(p.displayName())
+                p.logger.parent = logging.getLogger()
             return p.logger
         else:
             return logging.getLogger()
@@ -106,18 +154,21 @@ class Process(object):
             cls._remove_current_process(current_pid)
     
     @classmethod
-    def spawn(cls, fun, args=(), name=None):
-        """ Create a new process and return its PID. """
-        return cls._spawn(fun, args, name, None)
+    def spawn(cls, fun, args=(), name=None, queueSize=None, queueBytes=None):
+        """
+        Create a new process and return its PID. If queueSize or queueBytes are None,
+        the process' queue uses the default (Process.queueSize and Process.queueBytes).
+        """
+        return cls._spawn(fun, args, name, None, queueSize, queueBytes)
     
     @classmethod
-    def spawn_linked(cls, fun, args=(), name=None):
+    def spawn_linked(cls, fun, args=(), name=None, queueSize=None, queueBytes=None):
         """ Create a new process linked to the current one and return its PID.
         When a process dies, every process in its link set is killed. """
         currentPid = cls.current()
         if not currentPid:
             raise Exception("The current thread has no PID")
-        return cls._spawn(fun, args, name, currentPid)
+        return cls._spawn(fun, args, name, currentPid, queueSize, queueBytes)
     
     @classmethod
     def trap_exit(cls):
@@ -130,19 +181,60 @@ class Process(object):
             cls._processes[currentPid].trapExit = True
     
     @classmethod
-    def _spawn(cls, fun, args=(), name=None, linkedPid=None):
+    def spawn_actor(cls, actor, pool, name=None, queueSize=None, queueBytes=None):
+        """
+        Create a new process that runs on a worker pool and return its PID.
+        The actor's runSlice() method is called by a worker thread every time
+        the process has messages to handle (see ProcessBase). The pool must not
+        reject callables (e.g. a WorkerPool with maxQueued), or the process could be
+        left unable to run.
+        """
+        return cls._spawn_actor(actor, pool, name, None, queueSize, queueBytes)
+    
+    @classmethod
+    def spawn_linked_actor(cls, actor, pool, name=None, queueSize=None, queueBytes=None):
+        """ Create a new process that runs on a worker pool and is linked to the current one. """
+        currentPid = cls.current()
+        if not currentPid:
+            raise Exception("The current thread has no PID")
+        return cls._spawn_actor(actor, pool, name, currentPid, queueSize, queueBytes)
+    
+    @classmethod
+    def _spawn(cls, fun, args=(), name=None, linkedPid=None, queueSize=None, queueBytes=None):
         with cls._lock:
             pid = cls._new_id()
-            p = cls._create_process(pid, name)
-            if linkedPid:
-                p.linked.add(linkedPid)
-                cls._processes[linkedPid].linked.add(pid)
+            p = cls._create_process(pid, name, queueSize, queueBytes)
+            cls._link(p, linkedPid)
         p.thread = threading.Thread(target=cls._entry,
             name=p.displayName(), args=(pid, fun, args))
         #p.thread.daemon = True
         p.thread.start()
         return pid
     
+    @classmethod
+    def _spawn_actor(cls, actor, pool, name=None, linkedPid=None, queueSize=None, queueBytes=None):
+        if getattr(pool, "maxQueued", None) is not None:
+            raise ValueError("Processes can't run on a pool with a bounded queue ('%s')" % pool.name)
+        with cls._lock:
+            pid = cls._new_id()
+            p = cls._create_process(pid, name, queueSize, queueBytes)
+            cls._link(p, linkedPid)
+            p.actor = actor
+            p.pool = pool
+            p.runLock = threading.Lock()
+            p.parkLock = threading.Lock()
+            p.scheduled = True
+            p.queue.listener = lambda: cls._wake(p)
+        # the first slice initializes the process
+        pool.submit(cls._run_slice, p)
+        return pid
+    
+    @classmethod
+    def _link(cls, p, linkedPid):
+        if linkedPid:
+            p.linked.add(linkedPid)
+            cls._processes[linkedPid].linked.add(p.pid)
+    
     @classmethod
     def _entry(cls, pid, fun, args):
         with cls._lock:
@@ -150,99 +242,312 @@ class Process(object):
             p = cls._current.p
         log = cls.logger()
         log.info("Process started.")
+        gracefulExit, exitReason = False, "exception"
+        try:
+            gracefulExit, exitReason = cls._invoke(log, fun, *args) or (True, None)
+        finally:
+            cls._exited(p, gracefulExit, exitReason, log)
+    
+    @classmethod
+    def _run_slice(cls, p):
+        """ Let a process running on a worker pool handle its messages, then give the thread back. """
+        with p.runLock:
+            p.scheduled = False
+            p.running = True
+        # the pool might run on a thread which has its own process (e.g. a simulation)
+        previous = getattr(cls._current, "p", None)
+        cls._current.p = p
+        log = cls.logger()
+        if p.state is None:
+            log.info("Process started.")
+        status = (False, "exception")
+        try:
+            status = cls._invoke(log, p.actor.runSlice)
+        finally:
+            if status is None:
+                cls._reschedule(p)
+            else:
+                p.exited = True
+                cls._exited(p, status[0], status[1], log)
+            if previous is not None:
+                cls._current.p = previous
+            elif hasattr(cls._current, "p"):
+                del cls._current.p
+    
+    @classmethod
+    def _wake(cls, p):
+        """ Make sure a process running on a worker pool will handle its messages. """
+        with p.runLock:
+            if p.exited or p.scheduled or p.parked:
+                # a process waiting to send its parked messages is woken up once they are sent
+                return
+            elif p.running:
+                # the worker will check the queue again before giving the thread back
+                p.notified = True
+                return
+            p.scheduled = True
+        p.pool.submit(cls._run_slice, p)
+    
+    @classmethod
+    def _reschedule(cls, p):
+        """ Called after a slice. Submit the process again if it still has messages to handle. """
+        with p.runLock:
+            p.running = False
+            if p.parked:
+                return
+            elif p.notified or (p.queue.pending > 0) or p.saved:
+                p.notified = False
+                p.scheduled = True
+            else:
+                return
+        p.pool.submit(cls._run_slice, p)
+    
+    @classmethod
+    def _park(cls, p, pid, lane, queue, messages, create):
+        """
+        Park the messages after those which couldn't be sent to the lane yet and return True.
+        If there are none, only park them if create is true, otherwise return False.
+        """
+        key = (pid, lane)
+        with p.parkLock:
+            if p.parked is None:
+                p.parked = {}
+            parked = p.parked.get(key)
+            if parked is not None:
+                parked[1].extend(messages)
+                return True
+            elif not create:
+                return False
+            first = not p.parked
+            p.parked[key] = (queue, deque(messages))
+        if first:
+            _timers.schedule(cls.retryDelay, cls._send_parked, p)
+        return True
+    
+    @classmethod
+    def _send_parked(cls, p):
+        """ Try again to send the parked messages of the process, then wake it up once they are all sent. """
+        with p.parkLock:
+            for key, (queue, messages) in p.parked.items():
+                try:
+                    n = queue.put_many(messages, key[1], 0)
+                except QueueClosedError:
+                    # the process exited, like with try_send() the messages are lost
+                    n = len(messages)
+                # once the process is killed or has exited its messages don't need to be sent
+                if n < len(messages) and p.queue.isOpen:
+                    for i in xrange(n):
+                        messages.popleft()
+                else:
+                    del p.parked[key]
+            done = not p.parked
+        if done:
+            cls._wake(p)
+        else:
+            _timers.schedule(cls.retryDelay, cls._send_parked, p)
+    
+    @classmethod
+    def _is_parked(cls):
+        """ Determine whether the current process has messages waiting to be sent (see send()). """
+        return bool(cls._current.p.parked)
+    
+    @classmethod
+    def _invoke(cls, log, fun, *args):
+        """
+        Invoke the callable. If it raised an exception that means the process has to stop,
+        return (gracefulExit, exitReason). Otherwise return None.
+        """
         try:
             fun(*args)
-            gracefulExit = True
-            exitReason = None
         except ProcessExit as e:
-            exitReason = e.reason
-            if exitReason is None:
-                gracefulExit = True
+            if e.reason is None:
+                return True, None
             else:
                 log.error("Process exited with reason %s." % repr(e.reason))
-                gracefulExit = False
+                return False, e.reason
         except ProcessKilled:
-            gracefulExit = False
-            exitReason = "killed"
+            return False, "killed"
         except NoMatchException as nme:
             log.error(str(nme))
-            gracefulExit = False
-            exitReason = "no-match"
+            return False, "no-match"
         except Exception:
             log.exception("An exception was raised by the process")
-            gracefulExit = False
-            exitReason = "exception"
-        finally:
-            with cls._lock:
-                if not gracefulExit:
-                    log.error("Process died.")
-                else:
-                    log.info("Process stopped.")
-                # notify/kill linked processes
-                for linkedPid in p.linked:
-                    linkedProcess = cls._processes[linkedPid]
-                    if linkedProcess.trapExit:
-                        Process.try_send(linkedPid, Event("exit", pid, exitReason))
-                    elif not gracefulExit and linkedProcess.queue.close():
-                        log.error("Killing linked process %d.", linkedPid)
-                cls._remove_current_process(pid)
+            return False, "exception"
+        else:
+            return None
+    
+    @classmethod
+    def _exited(cls, p, gracefulExit, exitReason, log):
+        """ Notify or kill the processes linked to the current one, which just stopped. """
+        with cls._lock:
+            if not gracefulExit:
+                log.error("Process died.")
+            else:
+                log.info("Process stopped.")
+            # close the queue first, so that linked processes can't send messages to us after being notified
+            p.queue.close()
+            # notify/kill linked processes
+            for linkedPid in p.linked:
+                linkedProcess = cls._processes.get(linkedPid)
+                if linkedProcess is None:
+                    continue
+                elif linkedProcess.trapExit:
+                    # don't use send(), which fails when the current process was killed
+                    try:
+                        linkedProcess.queue.put(Event("exit", p.pid, exitReason))
+                    except QueueClosedError:
+                        pass
+                elif not gracefulExit and linkedProcess.queue.close():
+                    log.error("Killing linked process %d.", linkedPid)
+            cls._remove_current_process(p.pid)
     
     @classmethod
     def _getQueue(cls, pid):
         """ Return the queue of the specified process. """
-        with cls._lock:
-            try:
-                p = cls._processes[pid]
-            except KeyError:
+        # processes are only added and removed with the lock held, but looking up
+        # a key is atomic so there is no need to take the lock here
+        p = cls._processes.get(pid)
+        if p is None:
+            if 0 < pid < cls._nextID:
+                raise ProcessExited("Can't send a message to a stopped process (PID: %i)" % pid)
+            else:
                 raise Exception("Invalid PID")
         return p.queue
     
     @classmethod
-    def _getQueueCached(cls, pid):
-        """ Return the queue of the specified process, using the cache if possible. """
-        if not hasattr(cls._current, "queues"):
-            cls._current.queues = {}
+    def _getQueueCached(cls, p, pid):
+        """ Return the queue of the specified process, using the cache of process p if possible. """
         try:
-            return cls._current.queues[pid]
+            return p.queueCache[pid]
         except KeyError:
             queue = cls._getQueue(pid)
-            cls._current.queues[pid] = queue
+            cache = p.queueCache
+            if len(cache) >= cls.queueCacheSize:
+                # queues of processes that exited are only removed when sending fails
+                cache.clear()
+            cache[pid] = queue
             return queue
     
     @classmethod
-    def send(cls, pid, m):
-        """ Send a message to the specified process. """
-        if not cls._current.p.queue.isOpen:
+    def send(cls, pid, m, lane=None, timeout=None):
+        """
+        Send a message to the specified process. If lane is None, the message's lane
+        attribute is used if it has one, otherwise the message goes in the control lane.
+        If timeout is not None and the lane is still full after that many seconds,
+        raise WaitTimeoutError (a timeout of 0 never waits).
+        
+        A process running on a worker pool doesn't wait when timeout is None, since the process
+        it sends to might need the same thread: messages which don't fit are parked and sent
+        later, in order, and the process doesn't handle other messages until they are sent.
+        """
+        p = cls._current.p
+        if not p.queue.isOpen:
             raise ProcessKilled()
-        pid = cls._to_pid(pid)
-        queue = cls._getQueue(pid)
+        if type(pid) is not int:
+            pid = cls._to_pid(pid)
+        if lane is None:
+            lane = getattr(m, "lane", CONTROL_LANE)
+        queue = cls._getQueueCached(p, pid)
         try:
-            queue.put(m)
+            if (p.pool is not None) and (timeout is None):
+                if not (p.parked and cls._park(p, pid, lane, queue, [m], False)):
+                    try:
+                        queue.put(m, lane, 0)
+                    except WaitTimeoutError:
+                        cls._park(p, pid, lane, queue, [m], True)
+            else:
+                queue.put(m, lane, timeout)
         except QueueClosedError:
+            del p.queueCache[pid]
             raise ProcessExited("Can't send a message to a stopped process (PID: %i)" % pid)
     
     @classmethod
-    def try_send(cls, pid, m):
-        """ Send a message to the specified process. If the process exited, return False. """
+    def send_many(cls, pid, messages, lane=None, timeout=None):
+        """
+        Send several messages to the specified process, taking the queue's lock as few times as possible.
+        All the messages go in the same lane. If lane is None, it is chosen using the first message.
+        If timeout is not None, stop waiting for room in the lane after that many seconds.
+        Return the number of messages that were sent (or parked, see send()).
+        """
+        p = cls._current.p
+        if not p.queue.isOpen:
+            raise ProcessKilled()
+        if type(pid) is not int:
+            pid = cls._to_pid(pid)
+        messages = list(messages)
+        if not messages:
+            return 0
+        if lane is None:
+            lane = getattr(messages[0], "lane", CONTROL_LANE)
+        queue = cls._getQueueCached(p, pid)
+        try:
+            if (p.pool is not None) and (timeout is None):
+                if not (p.parked and cls._park(p, pid, lane, queue, messages, False)):
+                    n = queue.put_many(messages, lane, 0)
+                    if n < len(messages):
+                        cls._park(p, pid, lane, queue, messages[n:], True)
+                return len(messages)
+            return queue.put_many(messages, lane, timeout)
+        except QueueClosedError:
+            del p.queueCache[pid]
+            raise ProcessExited("Can't send a message to a stopped process (PID: %i)" % pid)
+    
+    @classmethod
+    def try_send(cls, pid, m, lane=None, timeout=None):
+        """
+        Send a message to the specified process. If the process exited, or if timeout
+        is not None and the message could not be sent in time, return False.
+        """
         pid = cls._to_pid(pid)
         try:
-            cls.send(pid, m)
+            cls.send(pid, m, lane, timeout)
             return True
-        except ProcessExited:
+        except (ProcessExited, WaitTimeoutError):
             return False
     
     @classmethod
-    def receive(cls):
-        """ Retrieve a message from the current process' queue. """
+    def receive(cls, pattern=None, timeout=None):
+        """
+        Retrieve the first message that matches the pattern from the current process' queue.
+        Messages that don't match are kept, in order, for later calls. If timeout is not None
+        and no matching message was received after that many seconds, raise WaitTimeoutError.
+        """
         try:
             p = cls._current.p
         except NameError:
             raise Exception("The current thread has no PID")
         try:
-            return p.queue.get()
+            if pattern is not None:
+                return cls._receive_match(p, pattern, timeout)
+            elif p.saved:
+                return p.saved.pop()
+            else:
+                return p.queue.get(timeout)
         except QueueClosedError:
             raise ProcessKilled("The process got killed (PID: %i)" % p.pid)
     
+    @classmethod
+    def _receive_match(cls, p, pattern, timeout):
+        """ Retrieve the first message that matches the pattern, saving the other ones. """
+        key = _leadingKey(pattern)
+        matches = compile_pattern(pattern)
+        if p.saved:
+            found, m = p.saved.take(matches, key)
+            if found:
+                return m
+        elif p.saved is None:
+            p.saved = SaveQueue()
+        if timeout is not None:
+            deadline = time.time() + timeout
+        remaining = None
+        while True:
+            if timeout is not None:
+                remaining = max(0.0, deadline - time.time())
+            m = p.queue.get(remaining)
+            if matches(m):
+                return m
+            p.saved.add(m)
+    
     @classmethod
     def try_receive(cls):
         """
@@ -254,21 +559,106 @@ class Process(object):
         except NameError:
             raise Exception("The current thread has no PID")
         try:
+            if p.saved:
+                return (True, p.saved.pop())
             return p.queue.get_unless_empty()
         except QueueClosedError:
             raise ProcessKilled("The process got killed (PID: %i)" % p.pid)
     
+    @classmethod
+    def has_messages(cls):
+        """
+        Determine whether the current process' queue holds any message, without taking any lock.
+        Loops that can't block in receive() can call this often to stay responsive.
+        """
+        try:
+            p = cls._current.p
+        except AttributeError:
+            raise Exception("The current thread has no PID")
+        return (p.queue.pending > 0) or bool(p.saved)
+    
+    @classmethod
+    def pending(cls, lane=None):
+        """
+        Return the number of messages in the current process' queue, or in one of its lanes,
+        without taking any lock. Messages set aside by a selective receive are not counted.
+        """
+        try:
+            p = cls._current.p
+        except AttributeError:
+            raise Exception("The current thread has no PID")
+        if lane is None:
+            return p.queue.pending
+        else:
+            return p.queue.pendingIn(lane)
+    
+    @classmethod
+    def pending_bytes(cls, lane):
+        """ Return the payload size of the messages in a lane of the current process' queue. """
+        try:
+            p = cls._current.p
+        except AttributeError:
+            raise Exception("The current thread has no PID")
+        return p.queue.bytesIn(lane)
+    
+    @classmethod
+    def receive_batch(cls, maxItems=None, block=True):
+        """
+        Retrieve up to maxItems messages (all of them if None) from the current process' queue.
+        If block is true, wait until there is at least one message. Otherwise the list can be empty.
+        """
+        try:
+            p = cls._current.p
+        except NameError:
+            raise Exception("The current thread has no PID")
+        try:
+            if p.saved:
+                batch = p.saved.popMany(maxItems)
+                if (maxItems is None) or (len(batch) < maxItems):
+                    left = None if maxItems is None else maxItems - len(batch)
+                    batch.extend(p.queue.drain(left, False))
+                return batch
+            return p.queue.drain(maxItems, block)
+        except QueueClosedError:
+            raise ProcessKilled("The process got killed (PID: %i)" % p.pid)
+    
+    @classmethod
+    def track_stats(cls, enabled=True):
+        """ Start (or stop) keeping track of statistics for the queues of all processes, current and future. """
+        with cls._lock:
+            cls.statsEnabled = enabled
+            for p in cls._processes.values():
+                p.queue.trackStats(enabled)
+    
+    @classmethod
+    def stats(cls, pid=None):
+        """
+        Return a dict with the statistics of the specified process' queue (the current process if None):
+        depth, high-water mark, number of messages in and out, time senders spent waiting for room
+        and the histogram of the time messages spent in the queue. Return None if the queue
+        doesn't track statistics (see track_stats()).
+        """
+        if pid is None:
+            p = cls._current.p
+        else:
+            pid = cls._to_pid(pid)
+            p = cls._processes.get(pid)
+            if p is None:
+                raise ProcessExited("The process is not running (PID: %i)" % pid)
+        stats = p.queue.stats()
+        if stats is not None:
+            stats["pid"] = p.pid
+            stats["name"] = p.displayName()
+        return stats
+    
     @classmethod
     def kill(cls, pid, flushQueue=True):
         """ Kill the specified process by closing its message queue. Return False on error. """
         pid = cls._to_pid(pid)
-        with cls._lock:
-            try:
-                p = cls._processes[pid]
-                queue = p.queue
-            except KeyError:
-                return False
-        queue.close(flushQueue)
+        p = cls._processes.get(pid)
+        if p is None:
+            return False
+        p.queue.close(flushQueue)
         return True
     
     @classmethod
@@ -294,8 +684,8 @@ class Process(object):
         return id
     
     @classmethod
-    def _create_process(cls, pid, name):
-        p = cls(pid, name)
+    def _create_process(cls, pid, name, queueSize=None, queueBytes=None):
+        p = cls(pid, name, queueSize, queueBytes)
         cls._processes[pid] = p
         return p
     
@@ -307,12 +697,22 @@ class Process(object):
     def _set_state(cls, state):
         cls._current.p.state = state
     
+    @classmethod
+    def _get_state(cls):
+        return cls._current.p.state
+    
     @classmethod
     def _remove_current_process(cls, current_pid):
+        """ Close the current process' queue and remove the process from the registry. The lock must be held. """
         p = cls._current.p
         p.queue.close()
+        p.queue.listener = None
         del cls._current.p
-        #del cls._processes[current_pid]
+        for linkedPid in p.linked:
+            linkedProcess = cls._processes.get(linkedPid)
+            if linkedProcess is not None:
+                linkedProcess.linked.discard(current_pid)
+        del cls._processes[current_pid]
 
 class ProcessExit(Exception):
     """ Exception raised when a process has to stop executing.
@@ -333,10 +733,14 @@ class ProcessState(object):
     pass
 
 class ProcessNotifier(object):
-    """ Notifies other processes by sending messages. """
+    """
+    Notifies other processes by sending messages. The suscribers are kept in a tuple that is
+    replaced (under the lock) when a process suscribes or unsuscribes, so sending a
+    notification doesn't need to take the lock.
+    """
     def __init__(self, lock=None):
         self.__lock = lock or threading.Lock()
-        self.__suscribers = set()
+        self.suscribers = ()
     
     def suscribe(self, pid=None):
         """ Suscribe a process to start receiving notifications. """
@@ -345,7 +749,8 @@ class ProcessNotifier(object):
             if not pid:
                 raise Exception("The current thread has no PID")
         with self.__lock:
-            self.__suscribers.add(pid)
+            if pid not in self.suscribers:
+                self.suscribers = self.suscribers + (pid, )
     
     def unsuscribe(self, pid=None):
         """ Unsuscribe a process to stop receiving notifications. """
@@ -354,54 +759,81 @@ class ProcessNotifier(object):
             if not pid:
                 raise Exception("The current thread has no PID")
         with self.__lock:
-            self.__suscribers.remove(pid)
+            if pid not in self.suscribers:
+                raise KeyError(pid)
+            self.suscribers = tuple(s for s in self.suscribers if s != pid)
 
     def __call__(self, m):
         """ Send a message to all suscribed processes. """
-        # don't send messages with the lock held, so need to copy the suscribers
-        with self.__lock:
-            suscribers = self.__suscribers.copy()
-        for pid in suscribers:
+        for pid in self.suscribers:
             try:
                 Process.send(pid, m)
             except Exception:
                 pass
 
-class ProcessMessage(Sequence):
-    """ Base class for messages that can be sent to a process."""
+class ProcessMessage(object):
+    """
+    Base class for messages that can be sent to a process. The items (type, name and params)
+    are stored in a tuple, which makes indexing and slicing cheap. Messages are sequences
+    but, like other objects, they are only equal to themselves.
+    """
+    __slots__ = ("_items", )
+    
     def __init__(self, name, *params):
-        self.type = self.__class__.__name__
-        self.name = name
-        self.params = params
+        self._items = (self.__class__.__name__, name) + params
+    
+    @property
+    def type(self):
+        return self._items[0]
+    
+    @property
+    def name(self):
+        return self._items[1]
+    
+    @property
+    def params(self):
+        return self._items[2:]
+    
+    @property
+    def payloadSize(self):
+        """ Number of bytes of data carried by the params (e.g. blocks of a file). """
+        return sum(payload_size(param) for param in self._items[2:])
     
     def __len__(self):
-        return 2 + len(self.params)
+        return len(self._items)
     
     def __getitem__(self, index):
-        if isinstance(index, slice):
-            return tuple(self)[index]
-        elif index == 0:
-            return self.type
-        elif index == 1:
-            return self.name
-        elif (index > 1) and (index < (len(self.params) + 2)):
-            return self.params[index - 2]
-        else:
-            raise IndexError("Index '%i' out of range" % index)
+        return self._items[index]
+    
+    def __iter__(self):
+        return iter(self._items)
+    
+    def __contains__(self, value):
+        return value in self._items
     
     def __str__(self):
-        return str(self[:])
+        return str(self._items)
     
     def __repr__(self):
-        return repr(self[:])
+        return repr(self._items)
+
+# messages don't inherit from Sequence, which would give them a __dict__
+Sequence.register(ProcessMessage)
 
 class Command(ProcessMessage):
     """ Contains information about a command sent to a process."""
-    pass
+    __slots__ = ()
 
 class Event(ProcessMessage):
     """ Contains information about an event sent by a process. """
-    pass
+    __slots__ = ()
+
+def payload_size(m):
+    """
+    Return the number of bytes of data carried by the message, which counts towards
+    the byte budget of queues. Only objects with a payloadSize attribute carry data.
+    """
+    return getattr(m, "payloadSize", 0)
 
 def match(pattern, o):
     """ Try to match an object against a pattern. Return True if the pattern is matched or False otherwise. """
@@ -438,6 +870,155 @@ def match(pattern, o):
     else:
         return False
 
+def compile_pattern(pattern):
+    """
+    Turn a pattern into a predicate that takes an object and gives the same result as match(pattern, o).
+    The pattern is only inspected once, so the predicate is much faster to call repeatedly.
+    The pattern must not be modified after being compiled.
+    """
+    if pattern is None:
+        return _matchAny
+    elif isinstance(pattern, type):
+        def matchType(o):
+            return isinstance(o, pattern) or (o is None) or (o is pattern)
+        return matchType
+    elif isinstance(pattern, basestring):
+        return lambda o: pattern == o
+    elif isinstance(pattern, Mapping):
+        items = [(key, compile_pattern(value)) for key, value in pattern.items()]
+        def matchMapping(o):
+            if not isinstance(o, Mapping):
+                return False
+            for key, predicate in items:
+                if (not key in o) or (not predicate(o[key])):
+                    return False
+            return True
+        return matchMapping
+    elif isinstance(pattern, Sequence):
+        n = len(pattern)
+        constants, predicates = [], []
+        for i, item in enumerate(pattern):
+            if item is None:
+                continue
+            elif isinstance(item, (type, Mapping, Sequence)) and not isinstance(item, basestring):
+                predicates.append((i, compile_pattern(item)))
+            else:
+                constants.append((i, item))
+        # compare constants first, they are cheap and the most likely to differ
+        constants, predicates = tuple(constants), tuple(predicates)
+        def matchSequence(o):
+            if (not _isSequence(o)) or (len(o) != n):
+                return False
+            for i, item in constants:
+                if not (item == o[i]):
+                    return False
+            for i, predicate in predicates:
+                if not predicate(o[i]):
+                    return False
+            return True
+        return matchSequence
+    else:
+        return lambda o: pattern == o
+
+def _matchAny(o):
+    return True
+
+_sequenceTypes = {}
+
+def _isSequence(o):
+    """ Same as isinstance(o, Sequence), but the result is cached for every type. """
+    cls = type(o)
+    try:
+        return _sequenceTypes[cls]
+    except KeyError:
+        result = _sequenceTypes[cls] = isinstance(o, Sequence)
+        return result
+
+def _leadingKey(o):
+    """
+    Return the first two items of a message (e.g. ("Command", "send")) or pattern
+    if they are both strings, None otherwise. A pattern can only match messages with the same key.
+    """
+    if isinstance(o, Sequence) and not isinstance(o, basestring) and (len(o) >= 2):
+        type, name = o[0], o[1]
+        if isinstance(type, basestring) and isinstance(name, basestring):
+            return (type, name)
+    return None
+
+class SaveQueue(object):
+    """
+    Messages that were skipped by a selective receive, in the order they were received.
+    They are indexed by type and name, so that looking for a message only tests those which could match.
+    """
+    def __init__(self):
+        # seq -> (message, key), in the order the messages were saved
+        self.messages = OrderedDict()
+        # key -> seqs of the messages with this key, oldest first
+        self.index = {}
+        self.nextSeq = 0
+    
+    def __len__(self):
+        return len(self.messages)
+    
+    def add(self, m):
+        """ Save the message at the end of the queue. """
+        seq = self.nextSeq
+        self.nextSeq += 1
+        key = _leadingKey(m)
+        self.messages[seq] = (m, key)
+        if key is not None:
+            self.index.setdefault(key, deque()).append(seq)
+    
+    def pop(self):
+        """ Remove and return the oldest message. The queue must not be empty. """
+        seq, (m, key) = self.messages.popitem(False)
+        if key is not None:
+            self._unindex(key, seq)
+        return m
+    
+    def popMany(self, maxItems=None):
+        """ Remove and return up to maxItems messages (all of them if None), oldest first. """
+        batch = []
+        while self.messages and ((maxItems is None) or (len(batch) < maxItems)):
+            batch.append(self.pop())
+        return batch
+    
+    def take(self, matches, key):
+        """
+        Remove the oldest message matching the compiled pattern, whose key is given (see _leadingKey).
+        Return (True, message) if there is one, otherwise (False, None).
+        """
+        messages = self.messages
+        if key is None:
+            for seq, (m, mkey) in messages.iteritems():
+                if matches(m):
+                    del messages[seq]
+                    if mkey is not None:
+                        self._unindex(mkey, seq)
+                    return (True, m)
+        else:
+            seqs = self.index.get(key)
+            if seqs:
+                for i, seq in enumerate(seqs):
+                    m = messages[seq][0]
+                    if matches(m):
+                        del messages[seq]
+                        del seqs[i]
+                        if not seqs:
+                            del self.index[key]
+                        return (True, m)
+        return (False, None)
+    
+    def _unindex(self, key, seq):
+        """ Remove the message's sequence from the index of its key. """
+        seqs = self.index[key]
+        if seqs[0] == seq:
+            seqs.popleft()
+        else:
+            seqs.remove(seq)
+        if not seqs:
+            del self.index[key]
+
 class EventSender(ProcessNotifier):
     """
     Event which can be suscribed by other processes.
@@ -446,10 +1027,16 @@ class EventSender(ProcessNotifier):
         Event("protocol-negociated", "SPARKv1") but not
         Event("protocol-negociated") or even
         Event("connected", "127.0.0.1:4550").
+    Events are checked against the pattern before being sent, unless validate is False.
+    They are sent in the given lane, or the event's lane if it is None.
     """
+    validate = True
+    lane = None
+    
     def __init__(self, name, *args):
         super(EventSender, self).__init__()
         self.pattern = Event(name, *args)
+        self.matches = compile_pattern(self.pattern)
     
     def suscribe(self, pid=None):
         """ Suscribe a process to start receiving events and return its pattern. """
@@ -459,11 +1046,14 @@ class EventSender(ProcessNotifier):
     def __call__(self, *args):
         """ Send a notification to all suscribed processes. """
         event = Event(self.pattern.name, *args)
-        if match(self.pattern, event):
-            super(EventSender, self).__call__(event)
-        else:
+        if self.validate and not self.matches(event):
             raise TypeError("%s doesn't match the pattern %s" %
                             (repr(event), repr(self.pattern)))
+        for pid in self.suscribers:
+            try:
+                Process.send(pid, event, self.lane)
+            except Exception:
+                pass
 
 class NoMatchException(Exception):
     """ Error that occurs when MessageMatcher.match() is called and no match was found. """
@@ -473,19 +1063,67 @@ def toPascalCase(tag):
     """ Convert the tag to Pascal case (e.g. "create-transfer" becomes "CreateTransfer"). """
     return "".join([word.capitalize() for word in tag.split("-")])
 
+def _handlerInvoker(method, n):
+    """
+    Return a callable that invokes the method with the message, its params and extra arguments.
+    Messages matched by a pattern have as many items as the pattern (n), so the common cases
+    can pass the params without slicing the message.
+    """
+    if n == 2:
+        def invokeHandler(m, *args):
+            method(m, *args)
+    elif n == 3:
+        def invokeHandler(m, *args):
+            method(m, m[2], *args)
+    elif n == 4:
+        def invokeHandler(m, *args):
+            method(m, m[2], m[3], *args)
+    else:
+        def invokeHandler(m, *args):
+            method(m, *(m[2:] + args))
+    # used by profilers
+    invokeHandler.handlerName = method.__name__
+    return invokeHandler
+
 class PatternMatcher(object):
-    """ Matches messages against a list of patterns. """
-    def __init__(self):
+    """
+    Matches messages against a list of patterns. When several patterns match a message,
+    the one that was added last wins.
+    """
+    # if not None, handlers are invoked through the profiler (e.g. a HandlerProfiler)
+    profiler = None
+    
+    def __init__(self, owner=None):
+        # name used to group handlers when profiling, e.g. the class of the process
+        self.owner = owner
         self.patterns = []
         self.predicates = []
+        # patterns starting with two strings, indexed by these strings (see _leadingKey)
+        # so that a message is only tested against the patterns with the same type and name
+        self.index = {}
+        # patterns that can't be indexed, e.g. Event(basestring)
+        self.wildcards = []
     
     def addPattern(self, pattern, callable=None, result=True):
         """ Add a pattern to match messages. """
         self.patterns.append((pattern, callable, result))
+        self._indexPattern(len(self.patterns) - 1, pattern, callable, result)
     
     def removePattern(self, pattern, callable=None, result=True):
         """ Remove a pattern from the list. """
         self.patterns.remove((pattern, callable, result))
+        self.index = {}
+        self.wildcards = []
+        for i, (pattern, callable, result) in enumerate(self.patterns):
+            self._indexPattern(i, pattern, callable, result)
+    
+    def _indexPattern(self, i, pattern, callable, result):
+        entry = (i, compile_pattern(pattern), callable, result)
+        key = _leadingKey(pattern)
+        if key is None:
+            self.wildcards.append(entry)
+        else:
+            self.index.setdefault(key, []).append(entry)
     
     def addHandlers(self, handler, *patterns):
         """ Calls addHandler() for every pattern in the list. """
@@ -496,6 +1134,7 @@ class PatternMatcher(object):
         """
         Add a rule that invokes the relevant handler methods when a message is matched.
         For example a 'connect' command would invoke the 'doCommand' method (with the default prefixes).
+        The method is looked up when the rule is added, which fails if the handler doesn't have it.
         """
         if match((basestring, basestring), pattern[0:2]):
             name = pattern.__class__.__name__
@@ -504,14 +1143,11 @@ class PatternMatcher(object):
             else:
                 prefix = name.lower()
             attrName = prefix + toPascalCase(pattern[1])
-            def invokeHandler(m, *args):
-                attr = getattr(handler, attrName, None)
-                if hasattr(attr, "__call__"):
-                    attr(m, *(m[2:] + args))
-                else:
-                    raise AttributeError("Could not find handler method '%s' for message %s"
-                        % (attrName, repr(m)))
-            self.addPattern(pattern, invokeHandler, result)
+            method = getattr(handler, attrName, None)
+            if not hasattr(method, "__call__"):
+                raise AttributeError("Could not find handler method '%s' for pattern %s"
+                    % (attrName, repr(pattern)))
+            self.addPattern(pattern, _handlerInvoker(method, len(pattern)), result)
         else:
             raise TypeError("pattern should be a message (sequence starting with two strings)")
     
@@ -522,11 +1158,29 @@ class PatternMatcher(object):
     
     def match(self, m, *args):
         """ Match the message against the patterns. """
-        for pattern, callable, result in reversed(self.patterns):
-            if match(pattern, m):
-                if callable:
+        found = None
+        key = _leadingKey(m)
+        if key is not None:
+            for entry in reversed(self.index.get(key, ())):
+                if entry[1](m):
+                    found = entry
+                    break
+        for entry in reversed(self.wildcards):
+            if (found is not None) and (entry[0] < found[0]):
+                # the indexed pattern was added after the remaining ones
+                break
+            elif entry[1](m):
+                found = entry
+                break
+        if found is not None:
+            i, predicate, callable, result = found
+            if callable:
+                profiler = self.profiler
+                if profiler is None:
                     callable(m, *args)
-                return result
+                else:
+                    profiler.invoke(self.owner, callable, m, args)
+            return result
         error = ["No pattern matched message %s.\nPossible patterns:" % repr(m)]
         for i, (pattern, callable, result) in enumerate(reversed(self.patterns)):
             error.append("%2d: %s" % (i, repr(pattern)))
@@ -541,6 +1195,30 @@ class PatternMatcher(object):
 
 class ProcessBase(object):
     """ Base class for processes with a message loop. """
+    # maximum number of messages to retrieve from the queue at once
+    # handlers that read the queue themselves (e.g. with try_receive) need this to be 1
+    batchSize = 1
+    # worker pool to run the process on, if None Process.defaultPool is used
+    pool = None
+    # processes that block for a long time (e.g. on sockets) should have their own thread
+    dedicatedThread = False
+    # maximum number of messages to handle before giving the worker thread back
+    sliceLength = 64
+    # if not None, processes run on this pool even if they need a dedicated thread (e.g. a Simulation)
+    forcedPool = None
+    # if not None, producers which can't send to the bulk lane without blocking can send
+    # Command("notify-drained", pid) and be sent Event("drained", self.pid) once the bulk lane
+    # holds no more than this many messages
+    lowWatermark = None
+    # if not None, producers are only notified once the payload of the bulk lane is this small too
+    lowWatermarkBytes = None
+    # capacity of the process' queue, if None Process.queueSize and Process.queueBytes are used
+    queueSize = None
+    queueBytes = None
+    # lane of the stop command. Processes which are mostly sent messages in the bulk lane
+    # can use it too, so that stop() doesn't overtake the messages which were sent before
+    stopLane = CONTROL_LANE
+    
     def __init__(self, name=None):
         self.pid = None
         if name:
@@ -551,15 +1229,34 @@ class ProcessBase(object):
     def start(self):
         """ Start the new process if it is not already running. """
         if not self.pid:
-            self.pid = Process.spawn(self.run, name=self.name)
+            pool = self.workerPool()
+            if pool:
+                self.pid = Process.spawn_actor(self, pool, self.name, self.queueSize, self.queueBytes)
+            else:
+                self.pid = Process.spawn(self.run, (), self.name, self.queueSize, self.queueBytes)
         return self.pid
     
     def start_linked(self):
         """ Start the new process as a linked process if it is not already running. """
         if not self.pid:
-            self.pid = Process.spawn_linked(self.run, name=self.name)
+            pool = self.workerPool()
+            if pool:
+                self.pid = Process.spawn_linked_actor(self, pool, self.name, self.queueSize, self.queueBytes)
+            else:
+                self.pid = Process.spawn_linked(self.run, (), self.name, self.queueSize, self.queueBytes)
         return self.pid
     
+    def workerPool(self):
+        """ Return the worker pool the process should run on, or None if it needs its own thread. """
+        if self.forcedPool is not None:
+            return self.forcedPool
+        elif self.dedicatedThread:
+            return None
+        elif self.pool is not None:
+            return self.pool
+        else:
+            return Process.defaultPool
+    
     def attach(self, queue=None):
         """ Create a process that is attached to the current thread and run it. """
         if not self.pid:
@@ -576,7 +1273,7 @@ class ProcessBase(object):
         """ Stop the process if it is running. """
         if self.pid:
             try:
-                Process.try_send(self.pid, Command("stop"))
+                Process.try_send(self.pid, Command("stop"), self.stopLane)
             except ProcessKilled:
                 Process.kill(self.pid)
             self.pid = None
@@ -588,6 +1285,8 @@ class ProcessBase(object):
     def initPatterns(self, loop, state):
         """ Initialize the patterns used by the message loop. """
         loop.addPattern(Command("stop"), result=False)
+        if self.lowWatermark is not None:
+            loop.addHandlers(self, Command("notify-drained", int))
         if debugger.enabled():
             loop.addPattern(Command("rpdb"), debugger.launch_remote)
             loop.addPattern(Command("pdb"), debugger.launch_local)
@@ -603,20 +1302,74 @@ class ProcessBase(object):
     
     def run(self):
         """ Run the process. This method blocks until the process has finished executing. """
-        state = ProcessState()
-        #HACK: make this better at some point
-        Process._set_state(state)
-        self.initState(state)
+        state = self._createState()
         try:
-            state.matcher = PatternMatcher()
-            self.initPatterns(state.matcher, state)
-            self.onStart(state)
+            self._startLoop(state)
             while True:
-                m = Process.receive()
-                self.handleMessage(m, state)
+                for m in Process.receive_batch(self.batchSize):
+                    self.handleMessage(m, state)
+                if state.drainWaiters:
+                    self._checkDrained(state)
         finally:
             self.cleanup(state)
     
+    def runSlice(self):
+        """
+        Handle the messages in the queue (at most sliceLength) without blocking, then return.
+        This is how the process runs on a worker pool. The first call initializes the process.
+        """
+        state = Process._get_state()
+        starting = state is None
+        if starting:
+            state = self._createState()
+        finished = True
+        try:
+            if starting:
+                self._startLoop(state)
+            handled = 0
+            while handled < self.sliceLength:
+                messages = Process.receive_batch(self.batchSize, False)
+                if not messages:
+                    break
+                for m in messages:
+                    self.handleMessage(m, state)
+                handled += len(messages)
+                if state.drainWaiters:
+                    self._checkDrained(state)
+                if Process._is_parked():
+                    # wait for the parked messages to be sent before handling more messages
+                    break
+            finished = False
+        finally:
+            if finished:
+                self.cleanup(state)
+    
+    def _createState(self):
+        state = ProcessState()
+        #HACK: make this better at some point
+        Process._set_state(state)
+        self.initState(state)
+        return state
+    
+    def _startLoop(self, state):
+        state.drainWaiters = []
+        state.matcher = PatternMatcher(self.__class__.__name__)
+        self.initPatterns(state.matcher, state)
+        self.onStart(state)
+    
+    def doNotifyDrained(self, m, senderPid, state):
+        if senderPid not in state.drainWaiters:
+            state.drainWaiters.append(senderPid)
+        self._checkDrained(state)
+    
+    def _checkDrained(self, state):
+        """ Notify the waiting producers if the bulk lane is below the low watermark. """
+        if (Process.pending(BULK_LANE) <= self.lowWatermark) and ((self.lowWatermarkBytes is None)
+                or (Process.pending_bytes(BULK_LANE) <= self.lowWatermarkBytes)):
+            waiters, state.drainWaiters = state.drainWaiters, []
+            for pid in waiters:
+                Process.try_send(pid, Event("drained", self.pid))
+    
     def cleanup(self, state):
         """ Perform cleanup tasks before the process stops.
         This is guaranteed to be called if the process state was initialized properly. """
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Pierre-André Saulais <pasaulais@free.fr>
+#
+# This file is part of the Spark File-transfer Tool.
+#
+# Spark is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Spark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spark; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+""" Measure how much time the message handlers of processes take. """
+
+import sys
+import time
+import json
+import weakref
+import threading
+
+__all__ = ["HandlerProfiler"]
+
+try:
+    import resource
+    # RUSAGE_THREAD is only exposed by Python 3, but Linux has supported it since 2.6.26
+    _RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD", 1 if sys.platform.startswith("linux") else None)
+except ImportError:
+    resource = None
+    _RUSAGE_THREAD = None
+
+if _RUSAGE_THREAD is not None:
+    def _cpuTime():
+        """ Return the CPU time used by the current thread. """
+        usage = resource.getrusage(_RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+else:
+    # this is the CPU time of the whole process, so it is only accurate with one busy thread
+    _cpuTime = time.clock
+
+class _HandlerStats(object):
+    __slots__ = ("calls", "sampled", "wallTotal", "wallMax", "cpuTotal", "cpuMax")
+    
+    def __init__(self):
+        self.calls = 0
+        self.sampled = 0
+        self.wallTotal = self.wallMax = 0.0
+        self.cpuTotal = self.cpuMax = 0.0
+    
+    def add(self, other):
+        """ Add the calls recorded by other (e.g. on another thread). """
+        self.calls += other.calls
+        self.sampled += other.sampled
+        self.wallTotal += other.wallTotal
+        self.cpuTotal += other.cpuTotal
+        self.wallMax = max(self.wallMax, other.wallMax)
+        self.cpuMax = max(self.cpuMax, other.cpuMax)
+
+def _addTable(totals, handlers):
+    """ Add the statistics of a (owner, name) -> _HandlerStats table to totals. """
+    for key, stats in handlers.items():
+        total = totals.get(key)
+        if total is None:
+            total = totals[key] = _HandlerStats()
+        total.add(stats)
+
+class _ThreadTable(object):
+    """ Statistics of the handlers invoked by one thread, only referenced by a thread-local. """
+    __slots__ = ("handlers", "__weakref__")
+    
+    def __init__(self):
+        self.handlers = {}
+
+class HandlerProfiler(object):
+    """
+    Record the number of calls and the wall and CPU time of message handlers, for every
+    process class and handler name. Only one call out of sampleEvery is timed, which keeps
+    the overhead low enough for the profiler to stay enabled.
+    Install it by setting PatternMatcher.profiler.
+    
+    Every thread records its calls in its own table, so that handlers running on different
+    threads don't contend for a lock. The tables are only added up by stats(), or when
+    their thread exits.
+    """
+    def __init__(self, sampleEvery=1):
+        if sampleEvery < 1:
+            raise ValueError("sampleEvery must be at least 1")
+        self.sampleEvery = sampleEvery
+        # the tables of exiting threads can be merged while the lock is held by the same thread
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        # weakref to _ThreadTable -> (owner, name) -> _HandlerStats for every live thread
+        self.tables = {}
+        # (owner, name) -> _HandlerStats for the threads that have exited
+        self.merged = {}
+    
+    def invoke(self, owner, callable, m, args):
+        """ Invoke the handler of a message for the owner (e.g. a process class name), timing it if sampled. """
+        name = getattr(callable, "handlerName", None) or getattr(callable, "__name__", None) or repr(callable)
+        key = (owner, name)
+        try:
+            handlers = self.local.table.handlers
+        except AttributeError:
+            table = self.local.table = _ThreadTable()
+            handlers = table.handlers
+            with self.lock:
+                self.tables[weakref.ref(table, self._threadExited)] = handlers
+        stats = handlers.get(key)
+        if stats is None:
+            stats = handlers[key] = _HandlerStats()
+        sampled = (stats.calls % self.sampleEvery) == 0
+        stats.calls += 1
+        if not sampled:
+            return callable(m, *args)
+        started, startedCpu = time.time(), _cpuTime()
+        try:
+            return callable(m, *args)
+        finally:
+            wall, cpu = time.time() - started, _cpuTime() - startedCpu
+            stats.sampled += 1
+            stats.wallTotal += wall
+            stats.cpuTotal += cpu
+            stats.wallMax = max(stats.wallMax, wall)
+            stats.cpuMax = max(stats.cpuMax, cpu)
+    
+    def _threadExited(self, ref):
+        """ Merge the table of a thread that has exited, so that it doesn't have to be kept. """
+        with self.lock:
+            handlers = self.tables.pop(ref, None)
+            if handlers is not None:
+                _addTable(self.merged, handlers)
+    
+    def reset(self):
+        """ Forget all the recorded calls. """
+        with self.lock:
+            # the tables have to be replaced before the thread-local drops them
+            self.tables = {}
+            self.merged = {}
+            self.local = threading.local()
+    
+    def stats(self):
+        """
+        Return a list of dicts with the statistics of every handler, the most expensive first.
+        The cumulative times only include sampled calls, the estimated ones are extrapolated to all calls.
+        """
+        totals = {}
+        with self.lock:
+            _addTable(totals, self.merged)
+            tables = list(self.tables.values())
+        # the counters of other threads might be slightly stale, but reading them is safe
+        for handlers in tables:
+            _addTable(totals, handlers)
+        table = []
+        for (owner, name), s in totals.items():
+            scale = float(s.calls) / s.sampled if s.sampled else 0.0
+            table.append({"process": owner, "handler": name, "calls": s.calls, "sampled": s.sampled,
+                          "wallTotal": s.wallTotal, "wallMax": s.wallMax, "wallEstimate": s.wallTotal * scale,
+                          "cpuTotal": s.cpuTotal, "cpuMax": s.cpuMax, "cpuEstimate": s.cpuTotal * scale})
+        table.sort(key=lambda row: row["wallEstimate"], reverse=True)
+        return table
+    
+    def to_json(self):
+        """ Return the statistics of every handler as JSON. """
+        return json.dumps(self.stats(), sort_keys=True)
+    
+    def dump(self, log):
+        """ Log the statistics of every handler as a table. """
+        lines = ["%-24s %-28s %10s %10s %10s %10s %10s" % ("Process", "Handler", "Calls",
+                 "Wall (s)", "Max (ms)", "CPU (s)", "Max (ms)")]
+        for row in self.stats():
+            lines.append("%-24s %-28s %10d %10.3f %10.3f %10.3f %10.3f" % (row["process"], row["handler"],
+                row["calls"], row["wallEstimate"], row["wallMax"] * 1000.0,
+                row["cpuEstimate"], row["cpuMax"] * 1000.0))
+        log.info("Handler profile (1 call out of %d sampled):\n%s", self.sampleEvery, "\n".join(lines))
@@ -19,8 +19,12 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from spark.core.tasks import WaitTimeoutError
 
-__all__ = ["BlockingQueue", "QueueClosedError"]
+__all__ = ["BlockingQueue", "QueueClosedError", "QueueStats"]
 
 def _iter_wrap(func):
     def wrapper(*args):
@@ -33,26 +37,89 @@ def _iter_wrap(func):
 class QueueClosedError(Exception):
     pass
 
+class QueueStats(object):
+    """ Counters updated by a queue which tracks statistics. """
+    # upper bounds (in seconds) of the latency histogram's buckets. The last bucket has no bound
+    latencyBounds = (0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
+    
+    def __init__(self):
+        self.putCount = 0
+        self.getCount = 0
+        self.highWater = 0
+        self.putBlockedTime = 0.0
+        self.latencies = [0] * (len(self.latencyBounds) + 1)
+    
+    def addLatency(self, latency):
+        """ Record the time an item spent in the queue. """
+        self.latencies[bisect_left(self.latencyBounds, latency)] += 1
+    
+    def snapshot(self, depth):
+        """ Return the counters as a dict. """
+        bounds = self.latencyBounds + (None, )
+        return {"depth": depth, "highWater": self.highWater,
+                "in": self.putCount, "out": self.getCount,
+                "putBlockedTime": self.putBlockedTime,
+                "latency": zip(bounds, self.latencies)}
+
 class BlockingQueue(object):
-    """ Blocking queue which can be used to pass objects between threads. """
-    def __init__(self, size, open=True, lock=None):
+    """
+    Blocking queue which can be used to pass objects between threads.
+    Producers and consumers wait on separate conditions, so that put() only wakes
+    up one consumer and get() only wakes up one producer. If size is None the queue
+    is unbounded.
+    
+    Items can be put in one of several lanes. Items are retrieved from the first lane
+    that is not empty, and in FIFO order within a lane. Each lane holds up to size items.
+    
+    If byteBudget is not None, items are also weighed by calling weigh(item) and a lane is
+    full when the weight of its items reaches byteBudget. A lane can always hold one item,
+    however heavy, so a lane holds at most byteBudget plus the weight of one item.
+    
+    If stats is true, the queue keeps track of statistics (see trackStats).
+    """
+    def __init__(self, size, open=True, lock=None, lanes=1, stats=False, byteBudget=None, weigh=None):
         if lock is None:
             self.__lock = threading.Lock()
         else:
             self.__lock = lock
-        self.__wait = threading.Condition(self.__lock)
+        self.__notEmpty = threading.Condition(self.__lock)
+        self.__notFull = [threading.Condition(self.__lock) for i in range(lanes)]
+        self.__drained = threading.Condition(self.__lock)
         self.__size = size
-        self.__count = 0
+        self.__laneCount = lanes
+        # number of threads waiting in get() and put(), so we don't notify for nothing
+        self.__getters = 0
+        self.__putters = [0] * lanes
         if open:
-            self.__list = []
+            self.__lanes = [deque() for i in range(lanes)]
         else:
-            self.__list = None
+            self.__lanes = None
+        # total number of items, across all lanes
+        self.__count = 0
+        # total weight of the items in every lane, when the queue has a byte budget
+        self.__byteBudget = byteBudget
+        self.__weigh = weigh
+        self.__bytes = [0] * lanes
+        # when tracking statistics, the time every item was put in the queue, for every lane
+        self.__stats = None
+        self.__times = None
+        # true when items don't need to be weighed or timed, so put() and get() can take shortcuts
+        self.__plain = byteBudget is None
+        if stats:
+            self.trackStats()
         self.__closing = False
+        # callable invoked when items are put into an empty queue or when the queue is closed
+        # it is called with the lock held, so it must not block or use the queue
+        self.listener = None
     
     def __iter__(self):
         """ Iterate over the items in the queue, calling get() until the queue is closed. """
-        while True:
-            yield self._iter_get()
+        get = self.get
+        try:
+            while True:
+                yield get()
+        except QueueClosedError:
+            return
     
     def iter_nowait(self):
         """ Iterate over the items in the queue, calling get() until the queue is empty or busy. """
@@ -61,28 +128,127 @@ class BlockingQueue(object):
             yield item
             success, item = self._iter_get_nowait()
     
-    def put(self, item):
-        """ Wait until the queue is not full, and put the item at the end. """
+    def put(self, item, lane=0, timeout=None):
+        """
+        Wait until the lane is not full, and put the item at the end. If timeout is not None
+        and the lane is still full after that many seconds, raise WaitTimeoutError.
+        """
         with self.__lock:
-            self.__assertWrite()
-            while self.__count == self.__size:
-                self.__wait.wait()
-                self.__assertWrite()
-            self.__list.append(item)
+            lanes = self.__lanes
+            if (lanes is None) or self.__closing:
+                raise QueueClosedError()
+            if self.__plain:
+                items = lanes[lane]
+                if len(items) == self.__size:
+                    self.__waitNotFull(lane, timeout)
+                    items = self.__lanes[lane]
+                items.append(item)
+                self.__count += 1
+                if (self.__count == 1) and self.listener:
+                    self.listener()
+                if self.__getters:
+                    self.__notEmpty.notify()
+                return
+            self.__waitNotFull(lane, timeout)
+            self.__lanes[lane].append(item)
             self.__count += 1
-            self.__wait.notifyAll()
+            if self.__byteBudget is not None:
+                self.__bytes[lane] += self.__weigh(item)
+            if self.__stats is not None:
+                self.__recordPut(lane, 1)
+            if (self.__count == 1) and self.listener:
+                self.listener()
+            if self.__getters:
+                self.__notEmpty.notify()
+    
+    def put_many(self, items, lane=0, timeout=None):
+        """
+        Put all the items at the end of the lane, waiting for room when it is full.
+        The items keep their relative order, but if the lane fills up other producers
+        might insert items in between. If timeout is not None, stop waiting for room after
+        that many seconds. Return the number of items that were put.
+        """
+        items = list(items)
+        n = len(items)
+        i = 0
+        with self.__lock:
+            self.__assertWrite()
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while i < n:
+                try:
+                    self.__waitNotFull(lane, None if timeout is None else deadline - time.time())
+                except WaitTimeoutError:
+                    break
+                laneItems = self.__lanes[lane]
+                room = n - i
+                if self.__size is not None:
+                    room = min(room, self.__size - len(laneItems))
+                if self.__byteBudget is not None:
+                    room = self.__weighMany(lane, items, i, room)
+                wasEmpty = (self.__count == 0)
+                laneItems.extend(items[i:i + room])
+                self.__count += room
+                if self.__stats is not None:
+                    self.__recordPut(lane, room)
+                i += room
+                if wasEmpty and self.listener:
+                    self.listener()
+                if self.__getters:
+                    self.__notEmpty.notify(room)
+        return i
     
-    def get(self):
-        """ Wait until the queue is not empty, and return the first item. """
+    def get(self, timeout=None):
+        """
+        Wait until the queue is not empty, and return the first item. If timeout is not None
+        and the queue is still empty after that many seconds, raise WaitTimeoutError.
+        """
         with self.__lock:
             self.__assertRead()
-            while self.__count == 0:
-                self.__wait.wait()
-                self.__assertRead()
-            item = self.__list.pop(0)
-            self.__count -= 1
-            self.__wait.notifyAll()
-        return item
+            if not self.__count:
+                self.__waitNotEmpty(timeout)
+            items = self.__lanes[0]
+            if items and self.__plain:
+                # shortcut for __pop()
+                self.__count -= 1
+                if self.__closing:
+                    self.__drained.notifyAll()
+                elif self.__putters[0]:
+                    self.__notFull[0].notify()
+                return items.popleft()
+            return self.__pop()
+    
+    def drain(self, maxItems=None, block=True):
+        """
+        Remove up to maxItems items (all of them if None) from the queue and return them as a list.
+        If block is true, wait until the queue is not empty. Otherwise the list can be empty.
+        """
+        with self.__lock:
+            self.__assertRead()
+            if block:
+                self.__waitNotEmpty()
+            batch = []
+            for lane, items in enumerate(self.__lanes):
+                if not items:
+                    continue
+                left = None if maxItems is None else maxItems - len(batch)
+                if (left is None) or (left >= len(items)):
+                    n = len(items)
+                    batch.extend(items)
+                    items.clear()
+                    self.__bytes[lane] = 0
+                else:
+                    n = left
+                    batch.extend(items.popleft() for i in xrange(left))
+                    if self.__byteBudget is not None:
+                        self.__bytes[lane] -= sum(self.__weigh(item) for item in batch[-n:])
+                self.__count -= n
+                if self.__stats is not None:
+                    self.__recordGet(lane, n)
+                self.__wakePutters(lane, n)
+                if len(batch) == maxItems:
+                    break
+            return batch
     
     _iter_get = _iter_wrap(get)
     
@@ -90,11 +256,8 @@ class BlockingQueue(object):
         """ If the queue is not empty, return (True, <first item>). Otherwise return (False, None). """
         with self.__lock:
             self.__assertRead()
-            if self.__count > 0:
-                item = self.__list.pop(0)
-                self.__count -= 1
-                self.__wait.notifyAll()
-                return (True, item)
+            if self.__count:
+                return (True, self.__pop())
             else:
                 return (False, None)
     
@@ -103,11 +266,8 @@ class BlockingQueue(object):
         if self.__lock.acquire(0):
             try:
                 self.__assertRead()
-                if self.__count > 0:
-                    item = self.__list.pop(0)
-                    self.__count -= 1
-                    self.__wait.notifyAll()
-                    return (True, item)
+                if self.__count:
+                    return (True, self.__pop())
                 else:
                     return (False, None)
             finally:
@@ -117,28 +277,188 @@ class BlockingQueue(object):
     
     _iter_get_nowait = _iter_wrap(get_nowait)
     
+    def __isFull(self, lane):
+        """ Determine whether the lane can't hold another item. The lock must be held. """
+        if len(self.__lanes[lane]) == self.__size:
+            return True
+        budget = self.__byteBudget
+        return (budget is not None) and (self.__bytes[lane] >= budget) and (len(self.__lanes[lane]) > 0)
+    
+    def __weighMany(self, lane, items, start, room):
+        """
+        Return how many of the items (at most room, from start) fit in the lane's byte budget
+        and add their weight to the lane's. The lock must be held.
+        """
+        budget = self.__byteBudget
+        weigh = self.__weigh
+        weight = self.__bytes[lane]
+        n = 0
+        while (n < room) and ((weight < budget) or (n == 0 and not self.__lanes[lane])):
+            weight += weigh(items[start + n])
+            n += 1
+        self.__bytes[lane] = weight
+        return n
+    
+    def __waitNotFull(self, lane, timeout=None):
+        """ Wait until there is room for at least one item in the lane. The lock must be held. """
+        if not self.__isFull(lane):
+            return
+        started = time.time()
+        remaining = None
+        try:
+            while self.__isFull(lane):
+                if timeout is not None:
+                    remaining = started + timeout - time.time()
+                    if remaining <= 0.0:
+                        raise WaitTimeoutError("The queue was still full after the specified duration")
+                self.__putters[lane] += 1
+                try:
+                    self.__notFull[lane].wait(remaining)
+                finally:
+                    self.__putters[lane] -= 1
+                self.__assertWrite()
+        finally:
+            if self.__stats is not None:
+                self.__stats.putBlockedTime += time.time() - started
+    
+    def __waitNotEmpty(self, timeout=None):
+        """ Wait until there is at least one item. The lock must be held. """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        remaining = None
+        while not self.__count:
+            if timeout is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0.0:
+                    raise WaitTimeoutError("No item was put in the queue within the specified duration")
+            self.__getters += 1
+            try:
+                self.__notEmpty.wait(remaining)
+            finally:
+                self.__getters -= 1
+            self.__assertRead()
+    
+    def __pop(self):
+        """ Remove the first item and wake up whoever can make progress. The lock must be held. """
+        items = self.__lanes[0]
+        if items and self.__plain:
+            item = items.popleft()
+            self.__count -= 1
+            if self.__closing:
+                self.__drained.notifyAll()
+            elif self.__putters[0]:
+                self.__notFull[0].notify()
+            return item
+        for lane, items in enumerate(self.__lanes):
+            if items:
+                item = items.popleft()
+                self.__count -= 1
+                if self.__byteBudget is not None:
+                    self.__bytes[lane] -= self.__weigh(item)
+                if self.__stats is not None:
+                    self.__recordGet(lane, 1)
+                self.__wakePutters(lane, 1)
+                return item
+    
+    def __recordPut(self, lane, n):
+        """ Update the statistics after n items were put in the lane. The lock must be held. """
+        stats = self.__stats
+        stats.putCount += n
+        if self.__count > stats.highWater:
+            stats.highWater = self.__count
+        now = time.time()
+        times = self.__times[lane]
+        for i in xrange(n):
+            times.append(now)
+    
+    def __recordGet(self, lane, n):
+        """ Update the statistics after n items were removed from the lane. The lock must be held. """
+        stats = self.__stats
+        stats.getCount += n
+        now = time.time()
+        times = self.__times[lane]
+        for i in xrange(n):
+            stats.addLatency(now - times.popleft())
+    
+    def __wakePutters(self, lane, n):
+        """ Wake up producers after n items were removed from the lane. The lock must be held. """
+        if self.__closing:
+            # close() might be waiting for the queue to be empty
+            self.__drained.notifyAll()
+        elif self.__putters[lane]:
+            self.__notFull[lane].notify(n)
+    
     def __assertWrite(self):
         """ Ensure that is it allowed to insert items into the queue. """
-        if (self.__list is None) or self.__closing:
+        if (self.__lanes is None) or self.__closing:
             raise QueueClosedError()
     
     def __assertRead(self):
         """ Ensure that is it allowed to read items from the queue. """
-        if (self.__list is None) or (self.__closing and (self.__count == 0)):
+        if (self.__lanes is None) or (self.__closing and not self.__count):
             raise QueueClosedError()
     
     def open(self):
         """ Create (or re-create) a closed queue, which will be empty. """
         with self.__lock:
-            if self.__list is None:
+            if self.__lanes is None:
                 self.__count = 0
-                self.__list = []
+                self.__bytes = [0] * self.__laneCount
+                self.__lanes = [deque() for i in range(self.__laneCount)]
+                if self.__stats is not None:
+                    self.__times = [deque() for i in range(self.__laneCount)]
+    
+    @property
+    def pending(self):
+        """
+        Return the number of items in the queue (0 if it is closed). This doesn't take the lock,
+        so it is cheap enough to be called in loops but the value might already be stale.
+        """
+        return self.__count
+    
+    def pendingIn(self, lane):
+        """ Return the number of items in the lane, without taking the lock (see pending). """
+        lanes = self.__lanes
+        if lanes is None:
+            return 0
+        else:
+            return len(lanes[lane])
+    
+    def bytesIn(self, lane):
+        """ Return the weight of the items in the lane (0 if the queue has no byte budget). """
+        return self.__bytes[lane]
+    
+    def trackStats(self, enabled=True):
+        """
+        Start (or stop) keeping track of statistics: depth, high-water mark, number of items put
+        and retrieved, time spent waiting in put() and the time items spent in the queue.
+        This makes put() and get() slightly slower.
+        """
+        with self.__lock:
+            if not enabled:
+                self.__stats = None
+                self.__times = None
+                self.__plain = self.__byteBudget is None
+            elif self.__stats is None:
+                self.__plain = False
+                self.__stats = QueueStats()
+                if self.__lanes is not None:
+                    # items already in the queue are considered to have just been put
+                    now = time.time()
+                    self.__times = [deque([now] * len(items)) for items in self.__lanes]
+    
+    def stats(self):
+        """ Return a dict with the statistics of the queue, or None if it doesn't track them. """
+        with self.__lock:
+            if self.__stats is None:
+                return None
+            return self.__stats.snapshot(self.__count)
     
     @property
     def isOpen(self):
         """ Determine whether the queue is opened or not. """
-        with self.__lock:
-            return self.__list is not None
+        # reading the attribute is atomic, there is no need to take the lock
+        return self.__lanes is not None
     
     def close(self, waitEmpty=False):
         """
@@ -151,15 +471,24 @@ class BlockingQueue(object):
         with self.__lock:
             if waitEmpty:
                 self.__closing = True
+                # producers waiting for the queue not to be full have to give up
+                for notFull in self.__notFull:
+                    notFull.notifyAll()
                 while self.__count > 0:
-                    self.__wait.wait()
-                    if self.__list is None:
+                    self.__drained.wait()
+                    if self.__lanes is None:
                         return
-            if self.__list is not None:
+            if self.__lanes is not None:
+                self.__lanes = None
+                self.__times = None
                 self.__count = 0
-                self.__list = None
                 self.__closing = False
-                self.__wait.notifyAll()
+                self.__notEmpty.notifyAll()
+                for notFull in self.__notFull:
+                    notFull.notifyAll()
+                self.__drained.notifyAll()
+                if self.listener:
+                    self.listener()
                 return True
             else:
-                return False
\ No newline at end of file
+                return False
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Pierre-André Saulais <pasaulais@free.fr>
+#
+# This file is part of the Spark File-transfer Tool.
+#
+# Spark is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Spark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spark; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+""" Worker threads which can run short tasks, such as processes handling their messages. """
+
+import threading
+import logging
+from spark.core.queue import BlockingQueue, QueueClosedError
+from spark.core.tasks import WaitTimeoutError
+
+__all__ = ["WorkerPool", "TaskRejectedError"]
+
+class WorkerPool(object):
+    """
+    Fixed set of threads executing the callables submitted to the pool, in order.
+    The threads are started when the first callable is submitted. If maxQueued is not None,
+    at most that many callables can wait for a thread and submit() rejects the other ones.
+    Such pools can't run processes (see Process.spawn_actor).
+    """
+    # pools shared by the callers using the same name (see named())
+    _named = {}
+    _namedLock = threading.Lock()
+    
+    def __init__(self, size=4, name="worker", maxQueued=None):
+        self.size = size
+        self.name = name
+        self.maxQueued = maxQueued
+        self.__lock = threading.Lock()
+        self.__tasks = BlockingQueue(maxQueued)
+        self.__threads = None
+        self.__running = 0
+        self.__completed = 0
+        self.__rejected = 0
+    
+    @classmethod
+    def named(cls, name, size=4, maxQueued=1024):
+        """
+        Return the pool with this name, creating it if needed. Subsystems can use their own pool
+        (e.g. one for disk I/O and one for the network) so that they don't starve each other.
+        """
+        with cls._namedLock:
+            pool = cls._named.get(name)
+            if pool is None:
+                pool = cls._named[name] = cls(size, name, maxQueued)
+            return pool
+    
+    def submit(self, fun, *args):
+        """ Queue the callable to be executed by one of the threads. """
+        if self.__threads is None:
+            self.__startThreads()
+        try:
+            if self.maxQueued is None:
+                self.__tasks.put((fun, args))
+            else:
+                self.__tasks.put((fun, args), 0, 0)
+        except QueueClosedError:
+            raise Exception("The pool has been shut down")
+        except WaitTimeoutError:
+            with self.__lock:
+                self.__rejected += 1
+            raise TaskRejectedError("The queue of the pool '%s' is full" % self.name)
+    
+    def stats(self):
+        """ Return the number of callables queued, running, completed and rejected as a dict. """
+        with self.__lock:
+            return {"name": self.name, "size": self.size, "queued": self.__tasks.pending,
+                    "running": self.__running, "completed": self.__completed,
+                    "rejected": self.__rejected}
+    
+    def shutdown(self, wait=True):
+        """ Stop the threads once every submitted callable has been executed. """
+        with WorkerPool._namedLock:
+            if WorkerPool._named.get(self.name) is self:
+                del WorkerPool._named[self.name]
+        self.__tasks.close(True)
+        if wait and self.__threads:
+            current = threading.current_thread()
+            for t in self.__threads:
+                if t is not current:
+                    t.join()
+    
+    def __startThreads(self):
+        with self.__lock:
+            if self.__threads is None:
+                threads = []
+                for i in range(self.size):
+                    t = threading.Thread(target=self.__entry, name="%s-%i" % (self.name, i + 1))
+                    t.daemon = True
+                    t.start()
+                    threads.append(t)
+                self.__threads = threads
+    
+    def __entry(self):
+        for fun, args in self.__tasks:
+            with self.__lock:
+                self.__running += 1
+            try:
+                fun(*args)
+            except Exception:
+                logging.exception("An exception was raised by a task of the pool '%s'", self.name)
+            finally:
+                with self.__lock:
+                    self.__running -= 1
+                    self.__completed += 1
+
+class TaskRejectedError(Exception):
+    """ Exception raised when a callable is submitted to a pool whose queue is full. """
+    pass
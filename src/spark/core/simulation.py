@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Pierre-André Saulais <pasaulais@free.fr>
+#
+# This file is part of the Spark File-transfer Tool.
+#
+# Spark is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Spark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spark; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+""" Deterministic execution of processes on a single thread, for tests and simulations. """
+
+import heapq
+import logging
+from collections import deque
+from spark.core.queue import QueueClosedError
+from spark.core.process import Process, ProcessBase, ProcessExited, CONTROL_LANE
+
+__all__ = ["Simulation"]
+
+class Simulation(object):
+    """
+    Run processes cooperatively on the current thread, in a deterministic order, with a virtual clock.
+    The simulation is a worker pool: while it is installed, every process started with ProcessBase
+    runs on it, including those which normally need a dedicated thread. Processes must not block,
+    so they can't use sockets (see MemoryMessenger) and their queues are unbounded.
+    Processes spawned with Process.spawn still have their own thread.
+    
+    Example:
+        with Simulation() as sim:
+            session = FileSharingSession()
+            session.start()
+            ...
+            sim.run()
+    """
+    def __init__(self):
+        self.time = 0.0
+        self.steps = 0
+        self.tasks = deque()
+        self.timers = []
+        self.nextTimer = 0
+        self.saved = None
+    
+    def __enter__(self):
+        self.install()
+        return self
+    
+    def __exit__(self, type, val, tb):
+        self.uninstall()
+    
+    def install(self):
+        """ Make processes started from now on run on the simulation. """
+        if self.saved is None:
+            self.saved = (ProcessBase.forcedPool, Process.boundedQueues)
+            ProcessBase.forcedPool = self
+            # putting a message in a full queue would block the only thread
+            Process.boundedQueues = False
+    
+    def uninstall(self):
+        """ Restore the previous worker pool. """
+        if self.saved is not None:
+            ProcessBase.forcedPool, Process.boundedQueues = self.saved
+            self.saved = None
+    
+    def now(self):
+        """ Return the virtual time, in seconds since the simulation started. """
+        return self.time
+    
+    def submit(self, fun, *args):
+        """ Queue the callable to be executed by run(). """
+        self.tasks.append((fun, args))
+    
+    def shutdown(self, wait=True):
+        """ Forget the callables which have not been executed yet. """
+        self.tasks.clear()
+        self.timers = []
+    
+    def call_later(self, delay, fun, *args):
+        """ Queue the callable to be executed once the virtual clock has advanced by delay seconds. """
+        heapq.heappush(self.timers, (self.time + delay, self.nextTimer, fun, args))
+        self.nextTimer += 1
+    
+    def send_after(self, delay, pid, m, lane=None):
+        """ Send a message to the process once the virtual clock has advanced by delay seconds. """
+        self.call_later(delay, self._deliver, pid, m, lane)
+    
+    def _deliver(self, pid, m, lane):
+        if lane is None:
+            lane = getattr(m, "lane", CONTROL_LANE)
+        try:
+            Process._getQueue(pid).put(m, lane)
+        except (ProcessExited, QueueClosedError):
+            # like Process.try_send, the process might have exited before the timer expired
+            pass
+    
+    def step(self):
+        """
+        Execute the next callable, advancing the virtual clock to the next timer if there is
+        nothing else to do. Return False if there was nothing to execute.
+        """
+        if self.tasks:
+            fun, args = self.tasks.popleft()
+        elif self.timers:
+            time, seq, fun, args = heapq.heappop(self.timers)
+            self.time = max(self.time, time)
+        else:
+            return False
+        self.steps += 1
+        try:
+            fun(*args)
+        except Exception:
+            logging.exception("An exception was raised by a task of the simulation")
+        return True
+    
+    def run(self, until=None, maxSteps=None):
+        """
+        Execute callables until there is nothing left to do, the virtual clock reaches until
+        or maxSteps callables have been executed. Return the number of callables executed.
+        """
+        steps = 0
+        while (maxSteps is None) or (steps < maxSteps):
+            if (not self.tasks) and (until is not None) and \
+                    ((not self.timers) or (self.timers[0][0] > until)):
+                self.time = max(self.time, until)
+                break
+            elif not self.step():
+                break
+            steps += 1
+        return steps
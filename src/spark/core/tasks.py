@@ -20,7 +20,11 @@
 
 from __future__ import absolute_import
 import types
+import time
+import heapq
+import logging
 import threading
+import weakref
 
 # Support for poor man's exception chaining with Python 2.x
 import sys
@@ -28,22 +32,53 @@ import traceback
 from io import StringIO
 
 __all__ = ["Future", "FutureFrozenError", "TaskError", "TaskFailedError", "TaskCanceledError",
-           "WaitTimeoutError", "Delegate", "threadedMethod", "coroutine"]
+           "WaitTimeoutError", "CancelToken", "Delegate", "threadedMethod", "coroutine"]
 
-def threadedMethod(func):
+def threadedMethod(func=None, pool="threaded", cancelable=False):
     """
-    When the function is called a thread is started, which executes the function
-    and appropriately calls completed() with the result values or failed().
+    When the function is called it is executed by a thread of a worker pool, which
+    appropriately calls completed() with the result values or failed(). The pool can be
+    a WorkerPool or the name of a shared pool (see WorkerPool.named), for example:
+        @threadedMethod(pool="disk")
+        def readFile(path):
+            ...
+    If the pool's queue is full the future fails with TaskRejectedError.
+    
+    The function is not called if the future is canceled before a thread is available.
+    If cancelable is true, the function is passed a CancelToken as first argument,
+    which it can check to stop early when the future is canceled.
     """
+    if func is None:
+        return lambda func: threadedMethod(func, pool, cancelable)
     def wrapper(*args, **kw):
         cont = Future()
-        newArgs = (func, ) + args
-        t = threading.Thread(target=cont.run, args=newArgs, kwargs=kw)
-        t.daemon = True
-        t.start()
+        if cancelable:
+            token = CancelToken()
+            cont.on_cancel(token.cancel)
+            args = (token, ) + args
+        try:
+            _threadedPool(pool).submit(_runThreaded, cont, func, args, kw)
+        except Exception:
+            cont.failed()
         return cont
     return wrapper
 
+def _runThreaded(cont, func, args, kw):
+    if cont.pending:
+        try:
+            result = func(*args, **kw)
+        except Exception:
+            cont._tryAssign(False)
+        else:
+            cont._tryAssign(True, result)
+
+def _threadedPool(pool):
+    if isinstance(pool, basestring):
+        from spark.core.scheduler import WorkerPool
+        return WorkerPool.named(pool)
+    else:
+        return pool
+
 def coroutine(func):
     """
     Wrap a generator function to act as a coroutine. The new function creates a
@@ -60,11 +95,16 @@ class Future(object):
     Represents a task whose result will be known in the future.
     """
     def __init__(self):
-        self.__callback = None
-        self.__args = None
+        # list of (callback, args) to invoke when the task is done, created when needed
+        self.__callbacks = None
+        # same for when the task is canceled
+        self.__cancelCallbacks = None
+        # future the coroutine run by this future is waiting for, if any
+        self.__awaited = None
         self.__result = None
-        self.__lock = threading.RLock()
-        self.__wait = threading.Condition(self.__lock)
+        self.__lock = threading.Lock()
+        # most futures are never waited on, so the condition is only created by wait()
+        self.__wait = None
     
     @classmethod
     def done(cls, result=None):
@@ -84,9 +124,96 @@ class Future(object):
         f.failed(e)
         return f
     
+    @classmethod
+    def all(cls, futures):
+        """
+        Create a future which is completed with the list of results once all the futures are
+        completed, or which fails as soon as one of them fails.
+        """
+        futures = list(futures)
+        results = [None] * len(futures)
+        left = [len(futures)]
+        lock = threading.Lock()
+        combined = cls()
+        def done(prev, i):
+            try:
+                results[i] = prev.result
+            except Exception:
+                combined._tryAssign(False)
+                return
+            with lock:
+                left[0] -= 1
+                last = (left[0] == 0)
+            if last:
+                combined._tryAssign(True, results)
+        if not futures:
+            combined.completed(results)
+        for i, f in enumerate(futures):
+            f.after(done, i)
+        return combined
+    
+    @classmethod
+    def any(cls, futures):
+        """
+        Create a future which is completed with the first of the futures to be done,
+        whether it completed or failed. If there are no futures, it fails with ValueError.
+        """
+        futures = list(futures)
+        combined = cls()
+        if not futures:
+            combined.failed(ValueError("There are no futures to wait for"))
+        for f in futures:
+            f.after(lambda prev: combined._tryAssign(True, prev))
+        return combined
+    
+    def with_timeout(self, timeout):
+        """
+        Create a future with the same result as this one, but which fails with WaitTimeoutError
+        if the task isn't done after timeout seconds. The task itself is not canceled.
+        """
+        limited = Future()
+        def expired():
+            limited._tryAssign(False, WaitTimeoutError("The task didn't complete within the specified duration"))
+        timer = _timers.schedule(timeout, expired)
+        self.after(_forward, limited, None)
+        # don't keep the new future alive until the timeout if the task is done first
+        self.after(lambda prev: _timers.cancel(timer))
+        return limited
+    
+    def map(self, fun):
+        """
+        Create a future which is completed with fun(result) once this one is completed.
+        If this future fails (or fun raises an exception), the new one fails too.
+        """
+        mapped = Future()
+        self.after(_forward, mapped, fun)
+        return mapped
+    
+    def then(self, fun):
+        """
+        Like map(), but fun returns a future (e.g. a coroutine) whose result is the result of the new future.
+        If fun returns something else, it is the result of the new future, like with map().
+        """
+        chained = Future()
+        def started(prev):
+            try:
+                nextFuture = fun(prev.result)
+            except Exception:
+                chained._tryAssign(False)
+            else:
+                if not isinstance(nextFuture, Future):
+                    chained._tryAssign(True, nextFuture)
+                    return
+                # canceling the chain cancels the task in progress
+                chained.on_cancel(nextFuture._tryCancel)
+                nextFuture.after(_forward, chained, None)
+        self.after(started)
+        return chained
+    
     """
     Invoke the callable or Future when the operation completes. If it was completed before, it is called before returning.
     The first argument of the function will be the Future, but optional args can be passed.
+    Several continuations can be added, they are invoked in the order they were added.
     Return True if the operation is complete, or False otherwise.
     """
     def after(self, continuation, *args):
@@ -94,11 +221,10 @@ class Future(object):
         with self.__lock:
             result = self.__result
             if result is None:
-                if self.__callback is None:
-                    self.__callback = callback
-                    self.__args = args
+                if self.__callbacks is None:
+                    self.__callbacks = [(callback, args)]
                 else:
-                    raise Exception("The continuation has already been set")
+                    self.__callbacks.append((callback, args))
         # don't invoke the callback with the lock held
         if result is not None:
             callback(*args)
@@ -118,6 +244,8 @@ class Future(object):
         This will raise an exception if the task failed or was canceled.
         """
         with self.__lock:
+            if (self.__result is None) and (self.__wait is None):
+                self.__wait = threading.Condition(self.__lock)
             if timeout is not None:
                 if self.__result is None:
                     self.__wait.wait(timeout)
@@ -155,24 +283,60 @@ class Future(object):
             self.completed(result)
     
     def _assignResult(self, success, result):
-        """ Set the result and invoke the callback, if any. """
-        callback = None
-        args = None
+        """ Set the result and invoke the callbacks, if any. """
         with self.__lock:
             if self.__result is None:
                 self.__result = (success, result)
-                self.__wait.notifyAll()
-                callback = self.__callback
-                args = self.__args
+                if self.__wait is not None:
+                    self.__wait.notifyAll()
+                callbacks = self.__callbacks
+                self.__callbacks = None
+                cancelCallbacks = self.__cancelCallbacks
+                self.__cancelCallbacks = None
             else:
                 if isinstance(self.__result[1], TaskCanceledError):
                     raise TaskCanceledError(self.__result[1].tb)
                 else:
                     raise FutureFrozenError("The result of the task has already been set")
         
-        # don't invoke the callback with the lock held
-        if callback is not None:
-            callback(*args)
+        # don't invoke the callbacks with the lock held, nor let one of them prevent the others from running
+        if callbacks is not None:
+            for callback, args in callbacks:
+                try:
+                    callback(*args)
+                except Exception:
+                    logging.exception("An exception was raised by a future's callback")
+        if cancelCallbacks is not None and isinstance(result, TaskCanceledError):
+            for callback, args in cancelCallbacks:
+                try:
+                    callback(*args)
+                except Exception:
+                    logging.exception("An exception was raised by a future's cancel callback")
+    
+    def _tryAssign(self, success, result=None):
+        """
+        Complete the task, or fail it with the result (the current exception if None),
+        unless it is already done. Used by futures which are done by whichever comes first.
+        """
+        try:
+            if success:
+                self.completed(result)
+            else:
+                self.failed(result)
+        except (FutureFrozenError, TaskCanceledError):
+            pass
+    
+    def _tryCancel(self):
+        """ Cancel the task unless it is already done. """
+        try:
+            self.cancel()
+        except (FutureFrozenError, TaskCanceledError):
+            pass
+    
+    def __await__(self):
+        """ Make the future awaitable by asyncio coroutines (see spark.core.aio). """
+        from spark.core.aio import to_asyncio
+        return to_asyncio(self).__await__()
     
     def _makeCallback(self, continuation):
         if hasattr(continuation, "__call__"):
@@ -200,8 +364,23 @@ class Future(object):
             error = TaskFailedError(type, val, tb)
         self._assignResult(False, error)
     
+    def on_cancel(self, fun, *args):
+        """
+        Invoke the callable when the task is canceled, e.g. to cancel the tasks it depends on.
+        If it was canceled before, the callable is invoked before returning.
+        """
+        with self.__lock:
+            result = self.__result
+            if result is None:
+                if self.__cancelCallbacks is None:
+                    self.__cancelCallbacks = []
+                self.__cancelCallbacks.append((fun, args))
+                return
+        if isinstance(result[1], TaskCanceledError):
+            fun(*args)
+    
     def cancel(self):
-        """ Cancel the task, making it impossible to complete. """
+        """ Cancel the task, making it impossible to complete, and the tasks it is waiting for. """
         tb = traceback.extract_stack()[:-1]
         self._assignResult(False, TaskCanceledError(tb))
     
@@ -213,47 +392,140 @@ class Future(object):
         """
         if not isinstance(coroutine, types.GeneratorType):
             raise TypeError("'coroutine' should be a generator")
-        self._coroutine_send(coroutine, None)
-    
-    def _coroutine_send(self, coroutine, value):
-        try:
-            result = coroutine.send(value)
-        except StopIteration:
-            # the coroutine exited
-            self.completed()
-        except:
-            # the coroutine raised an exception
-            self.failed()
-        else:
-            # the coroutine yielded something
-            self._coroutine_yielded(coroutine, result)
-    
-    def _coroutine_yielded(self, coroutine, result):
-        if hasattr(result, "after"):
-            result.after(self._coroutine_task_completed, coroutine)
-        else:
-            self.completed(result)
+        self.on_cancel(self._coroutine_canceled, coroutine)
+        self._coroutine_resume(coroutine, True, None)
     
-    def _coroutine_task_completed(self, prev, coroutine):
-        try:
-            result = prev.result
-        except:
-            # the task failed, propagate the exception to the coroutine
-            e = sys.exc_info()[1]
+    def _coroutine_resume(self, coroutine, success, value):
+        """
+        Send the value to the coroutine (or raise it in the coroutine if success is false), until it
+        yields a future which isn't done yet or exits. Futures which are already done are handled
+        in a loop, so that the stack doesn't grow with the number of futures the coroutine yields.
+        """
+        while True:
             try:
-                 result = coroutine.throw(e)
+                if success:
+                    result = coroutine.send(value)
+                else:
+                    result = coroutine.throw(value)
             except StopIteration:
-                # the coroutine handled the exception and exited
-                self.completed()
+                # the coroutine exited
+                self._tryAssign(True)
+                return
             except:
-                # the coroutine didn't handle the exception
-                self.failed()
-            else:
-                # the coroutine yielded something
-                self._coroutine_yielded(coroutine, result)
-        else:
-            # the task succeeded, send the result to the coroutine
-            self._coroutine_send(coroutine, result)
+                # the coroutine raised an exception
+                self._tryAssign(False)
+                return
+            if not hasattr(result, "after"):
+                self._tryAssign(True, result)
+                return
+            elif self.__result is not None:
+                # the coroutine was canceled but didn't exit
+                coroutine.close()
+                return
+            elif getattr(result, "pending", True):
+                # resume the coroutine when the task is done
+                self.__awaited = result
+                result.after(self._coroutine_task_completed, coroutine)
+                return
+            success, value = _futureResult(result)
+    
+    def _coroutine_task_completed(self, prev, coroutine):
+        if prev is self.__awaited:
+            self.__awaited = None
+            success, value = _futureResult(prev)
+            self._coroutine_resume(coroutine, success, value)
+    
+    def _coroutine_canceled(self, coroutine):
+        """ Cancel the task the coroutine is waiting for, which raises TaskCanceledError in the coroutine. """
+        awaited = self.__awaited
+        if awaited is None:
+            return
+        if hasattr(awaited, "_tryCancel"):
+            awaited._tryCancel()
+        if self.__awaited is awaited:
+            # the task couldn't be canceled, raise the exception in the coroutine anyway
+            self.__awaited = None
+            self._coroutine_resume(coroutine, False, TaskCanceledError(traceback.extract_stack()[:-1]))
+
+def _futureResult(f):
+    """ Return (True, result) if the task of the future succeeded, otherwise (False, exception). """
+    try:
+        return True, f.result
+    except:
+        return False, sys.exc_info()[1]
+
+def _forward(prev, target, fun):
+    """ Continuation which passes the result of prev (through fun if not None) to target. """
+    try:
+        result = prev.result
+        if fun is not None:
+            result = fun(result)
+    except Exception:
+        target._tryAssign(False)
+    else:
+        target._tryAssign(True, result)
+
+class _TimerThread(object):
+    """ Thread which invokes callables after a delay, so that waiting doesn't need a thread per wait. """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__changed = threading.Condition(self.__lock)
+        self.__timers = []
+        self.__next = 0
+        self.__canceled = 0
+        self.__thread = None
+    
+    def schedule(self, delay, fun, *args):
+        """ Invoke the callable after delay seconds. Return the timer, which can be passed to cancel(). """
+        with self.__lock:
+            self.__next += 1
+            timer = [time.time() + delay, self.__next, fun, args]
+            heapq.heappush(self.__timers, timer)
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__entry, name="timers")
+                self.__thread.daemon = True
+                self.__thread.start()
+            self.__changed.notify()
+        return timer
+    
+    def cancel(self, timer):
+        """ Don't invoke the callable of a timer if it is still pending, and release it. """
+        with self.__lock:
+            if timer[2] is None:
+                return
+            timer[2] = None
+            timer[3] = ()
+            self.__canceled += 1
+            # remove the canceled timers once they make up most of the heap
+            if self.__canceled * 2 > len(self.__timers):
+                self.__timers = [t for t in self.__timers if t[2] is not None]
+                heapq.heapify(self.__timers)
+                self.__canceled = 0
+    
+    def __entry(self):
+        while True:
+            with self.__lock:
+                while True:
+                    now = time.time()
+                    if self.__timers and (self.__timers[0][0] <= now):
+                        timer = heapq.heappop(self.__timers)
+                        due, id, fun, args = timer
+                        if fun is None:
+                            self.__canceled -= 1
+                            continue
+                        # make it look canceled, so that cancel() doesn't count it
+                        timer[2] = None
+                        break
+                    elif self.__timers:
+                        self.__changed.wait(self.__timers[0][0] - now)
+                    else:
+                        self.__changed.wait()
+            try:
+                fun(*args)
+            except Exception:
+                logging.exception("An exception was raised by a timer")
+
+_timers = _TimerThread()
 
 class FutureFrozenError(Exception):
     """ Exception raised when one tries to call completed() or failed() twice on a future. """
@@ -319,34 +591,93 @@ class TaskCanceledError(TaskError):
         trace = "|".join(lines)
         return "The task was canceled before it could be completed. %s" % trace
 
+class CancelToken(object):
+    """ Lets a task which runs on a thread know when it is canceled, so that it can stop early. """
+    def __init__(self):
+        self.canceled = False
+    
+    def cancel(self):
+        self.canceled = True
+    
+    def check(self):
+        """ Raise TaskCanceledError if the task was canceled. """
+        if self.canceled:
+            raise TaskCanceledError(traceback.extract_stack()[:-1])
+
 class Delegate(object):
     ''' Handles a list of methods and functions
     Usage:
-        d = Delegate([lock])
+        d = Delegate([lock], [weak])
         d += function    # Add function to end of delegate list
-        d(*args, **kw)   # Call all functions, returns a list of results
+        d(*args, **kw)   # Call all functions
+        d.collect(*args, **kw)   # Call all functions, returns a list of results
         d -= function    # Removes last matching function from list
+    The list is an immutable tuple which is replaced when functions are added or removed,
+    so calling the delegate doesn't need the lock. If weak is true, the delegate only keeps
+    weak references to bound methods, which are skipped once their object is garbage-collected
+    and removed the next time the list is changed.
     '''
-    def __init__(self, lock=None):
+    def __init__(self, lock=None, weak=False):
         self.__lock = lock or threading.Lock()
-        self.__delegates = []
+        self.__weak = weak
+        self.__delegates = ()
     
     def __iadd__(self, callback):
+        if self.__weak and getattr(callback, "im_self", None) is not None:
+            callback = _WeakMethod(callback)
         with self.__lock:
-            self.__delegates.append(callback)
+            self.__delegates = self.__live() + (callback, )
         return self
     
     def __isub__(self, callback):
         if hasattr(callback, "__call__"):
             with self.__lock:
-                for i in range(len(self.__delegates) - 1, -1, -1):
-                    if self.__delegates[i] == callback:
-                        del self.__delegates[i]
-                        return self
+                delegates = self.__live()
+                for i in range(len(delegates) - 1, -1, -1):
+                    if delegates[i] == callback:
+                        delegates = delegates[:i] + delegates[i + 1:]
+                        break
+                self.__delegates = delegates
         return self
     
+    def __live(self):
+        """ Return the list without the weak methods whose object was garbage-collected. """
+        # this isn't done by a weakref callback, which could run while the lock is held by the same thread
+        delegates = self.__delegates
+        if self.__weak:
+            delegates = tuple(d for d in delegates if not isinstance(d, _WeakMethod) or d.alive)
+        return delegates
+    
     def __call__(self, *args, **kw):
-        # don't call the callbacks with the lock held, so need to copy them
-        with self.__lock:
-            callbacks = self.__delegates[:]
-        return [callback(*args, **kw) for callback in callbacks]
\ No newline at end of file
+        for callback in self.__delegates:
+            callback(*args, **kw)
+    
+    def collect(self, *args, **kw):
+        """ Call all functions and return the list of their results. """
+        return [callback(*args, **kw) for callback in self.__delegates
+                if not isinstance(callback, _WeakMethod) or callback.alive]
+
+class _WeakMethod(object):
+    """ Bound method which doesn't keep its object alive. Calling it does nothing once the object is dead. """
+    def __init__(self, method):
+        self.func = method.im_func
+        self.ref = weakref.ref(method.im_self)
+    
+    @property
+    def alive(self):
+        return self.ref() is not None
+    
+    def __call__(self, *args, **kw):
+        obj = self.ref()
+        if obj is not None:
+            return self.func(obj, *args, **kw)
+    
+    def __eq__(self, other):
+        if isinstance(other, _WeakMethod):
+            return self is other
+        obj = self.ref()
+        return (obj is not None and getattr(other, "im_self", None) is obj
+                and getattr(other, "im_func", None) is self.func)
+    
+    def __ne__(self, other):
+        return not self.__eq__(other)
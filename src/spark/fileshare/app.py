@@ -37,14 +37,14 @@ class SparkApplication(object):
         self._uploadSpeed = 0.0
         self._downloadSpeed = 0.0
         self._files = {}
-        self.listening = Delegate()
-        self.connected = Delegate()
-        self.connectionError = Delegate()
-        self.disconnected = Delegate()
-        self.stateChanged = Delegate()
-        self.fileListUpdated = Delegate()
-        self.fileUpdated = Delegate()
-        self.transferFinished = Delegate()
+        self.listening = Delegate(weak=True)
+        self.connected = Delegate(weak=True)
+        self.connectionError = Delegate(weak=True)
+        self.disconnected = Delegate(weak=True)
+        self.stateChanged = Delegate(weak=True)
+        self.fileListUpdated = Delegate(weak=True)
+        self.fileUpdated = Delegate(weak=True)
+        self.transferFinished = Delegate(weak=True)
         self.session = FileSharingSession()
     
     def __enter__(self):
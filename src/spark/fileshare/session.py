@@ -215,7 +215,7 @@ class FileSharingSession(Service):
     def _blockReceived(self, b, state):
          transfer = state.transferTable.find(b.transferID, DOWNLOAD)
          if transfer:
-            Process.send(transfer.pid, b)
+            Process.send(transfer.pid, b, BULK_LANE)
     
     def doStopTransfer(self, m, fileID, state):
         """ Stop receiving the remote file with the given ID. """
@@ -231,8 +231,9 @@ class FileSharingSession(Service):
         """ The remote peer sent a 'close-transfer' request. """
         transfer = state.transferTable.find(transferID, UPLOAD)
         if transfer:
-            Process.send(transfer.pid, Command("close-transfer"))
-    
+            # the upload may already have closed itself
+            Process.try_send(transfer.pid, Command("close-transfer"))
+
     def onTransferStateChanged(self, m, transferID, direction, transferState, state):
         # TODO: remove this event, use only transfer-info-updated?
         transfer = state.transferTable.find(transferID, direction)
@@ -249,7 +250,8 @@ class FileSharingSession(Service):
         """ The remote peer sent a 'transfer-state-changed' notification. """
         transfer = state.transferTable.find(transferID, DOWNLOAD)
         if transfer:
-            Process.send(transfer.pid, Event("remote-state-changed", transferState))
+            # use the same lane as blocks, so that the state change doesn't overtake them
+            Process.send(transfer.pid, Event("remote-state-changed", transferState), BULK_LANE)
     
     def onTransferInfoUpdated(self, m, transferID, direction, transfer, state):
         cached = state.transferTable.find(transferID, direction)
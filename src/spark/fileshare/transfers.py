@@ -126,6 +126,8 @@ class Transfer(ProcessBase):
 
 class Upload(Transfer):
     direction = UPLOAD
+    # number of blocks to read before sending them to the messenger at once
+    blockBatch = 8
     
     def initState(self, state):
         """ Initialize the process state. """
@@ -133,12 +135,16 @@ class Upload(Transfer):
         state.messengerPid = None
         state.nextBlock = None
         state.offset = None
+        # blocks that didn't fit in the messenger's queue
+        state.unsent = None
     
     def initPatterns(self, loop, state):
         """ Initialize the patterns used by the message loop. """
         super(Upload, self).initPatterns(loop, state)
         loop.addHandlers(self,
-            Command("start-upload", int))
+            Command("start-upload", int),
+            Command("send-blocks"),
+            Event("drained", int))
     
     def doInitTransfer(self, m, transferID, direction, file, blockSize, sessionPid, state):
         state.logger.info("Initializing upload of file %s.", repr((file.ID, direction)))
@@ -154,33 +160,49 @@ class Upload(Transfer):
         state.logger.info("Starting to send.")
         state.started = datetime.now()
         self._changeTransferState(state, "active")
-        self._sendFile(state)
-    
-    def _sendFile(self, state):
-        while state.transferState == "active":
-            # we have to keep checking the process' message queue while sending blocks
-            # otherwise the process will be unresponsive (can't pause or cancel)
-            ok, m = Process.try_receive()
-            if ok:
-                self.handleMessage(m, state)
-            else:
-                self._sendBlock(state)
-    
-    def _sendBlock(self, state):
-        if state.nextBlock >= state.totalBlocks:
+        self._sendBlocks(state)
+    
+    def doSendBlocks(self, m, state):
+        if state.transferState == "active":
+            self._sendBlocks(state)
+    
+    def onDrained(self, m, messengerPid, state):
+        if (messengerPid == state.messengerPid) and (state.transferState == "active"):
+            self._sendBlocks(state)
+    
+    def _sendBlocks(self, state):
+        if state.unsent:
+            messages, state.unsent = state.unsent, None
+        elif state.nextBlock >= state.totalBlocks:
             self._transferComplete(state)
+            return
+        else:
+            # read a few blocks
+            messages = []
+            while (state.nextBlock < state.totalBlocks) and (len(messages) < self.blockBatch):
+                blockData = state.stream.read(state.blockSize)
+                state.offset += len(blockData)
+                block = Block(state.transferID, state.nextBlock, blockData)
+                state.nextBlock += 1
+                state.completedSize += len(blockData)
+                messages.append(Command("send", block, self.pid))
+        # send them without waiting for the messenger
+        sent = Process.send_many(state.messengerPid, messages, BULK_LANE, 0)
+        if sent < len(messages):
+            # keep the rest until the messenger's queue has drained
+            state.unsent = messages[sent:]
+            Process.send(state.messengerPid, Command("notify-drained", self.pid))
         else:
-            # read the block
-            blockData = state.stream.read(state.blockSize)
-            state.offset += len(blockData)
-            block = Block(state.transferID, state.nextBlock, blockData)
-            state.nextBlock += 1
-            state.completedSize += len(blockData)
-            # send it
-            Process.send(state.messengerPid, Command("send", block, self.pid))
+            # send the next blocks after handling the commands received in the meantime,
+            # which are in the control lane, so that the process stays responsive (e.g. can be cancelled)
+            Process.send(self.pid, Command("send-blocks"), BULK_LANE)
 
 class Download(Transfer):
     direction = DOWNLOAD
+    # blocks are written to the file as they come, there is no need to dispatch them one by one
+    batchSize = 16
+    # blocks waiting to be written use at most 4 MiB, whatever the block size
+    queueBytes = 4 * 1024 * 1024
     
     def initState(self, state):
         """ Initialize the process state. """
@@ -22,8 +22,10 @@
 from spark.messaging.messages import *
 from spark.messaging.parser import *
 from spark.messaging.protocol import *
+from spark.messaging.messenger import *
 from spark.messaging.transport import *
+from spark.messaging.memory import *
 
 __all__ = []
-for module in (messages, parser, protocol, transport):
+for module in (messages, parser, protocol, messenger, transport, memory):
     __all__.extend(module.__all__)
\ No newline at end of file
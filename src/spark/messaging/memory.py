@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009, 2010 Pierre-André Saulais <pasaulais@free.fr>
+#
+# This file is part of the Spark File-transfer Tool.
+#
+# Spark is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Spark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spark; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+""" Transport which exchanges messages between processes in memory, for tests and simulations. """
+
+import socket
+from spark.core import *
+from spark.messaging.messages import *
+from spark.messaging.parser import MessageReader
+from spark.messaging.messenger import MessengerMixin, routeRemoteMessage
+from spark.messaging.protocol import VERSION_ALPHA
+
+__all__ = ["MemoryMessenger"]
+
+class MemoryMessenger(MessengerMixin, ProcessBase):
+    """
+    Process that can send and receive messages like TcpMessenger, but which is connected
+    to another MemoryMessenger instead of using a socket. The addresses are only used to
+    find the messenger to connect to. Messages are formatted and parsed like they are by
+    TcpMessenger, so that the remote peer doesn't share objects with the sender.
+    """
+    # messengers listening to incoming connections, by address
+    listeners = {}
+    
+    def __init__(self):
+        # created before initializing the bases, which change the lane of 'disconnected'
+        self.listening = EventSender("listening", None)
+        self.connected = EventSender("connected", None)
+        self.disconnected = EventSender("disconnected")
+        super(MemoryMessenger, self).__init__()
+    
+    def connect(self, addr, family=socket.AF_INET, senderPid=None):
+        if not senderPid:
+            senderPid = Process.current()
+        Process.send(self.pid, Command("connect", addr, family, senderPid))
+    
+    def listen(self, addr, family=socket.AF_INET, senderPid=None):
+        if not senderPid:
+            senderPid = Process.current()
+        Process.send(self.pid, Command("listen", addr, family, senderPid))
+    
+    def accept(self, senderPid=None):
+        if not senderPid:
+            senderPid = Process.current()
+        Process.send(self.pid, Command("accept", senderPid))
+    
+    def initState(self, state):
+        super(MemoryMessenger, self).initState(state)
+        state.bindAddr = None
+        state.acceptingPid = None
+        state.isConnected = False
+        state.remoteAddr = None
+        state.peerPid = None
+        state.senderPid = None
+        state.routes = []
+        state.reader = MessageReader(None)
+    
+    def initPatterns(self, loop, state):
+        super(MemoryMessenger, self).initPatterns(loop, state)
+        loop.addHandlers(self,
+            # public messages
+            Command("connect", None, int, int),
+            Command("listen", None, int, int),
+            Command("accept", int),
+            Command("disconnect"),
+            Command("send", None, int),
+            Command("add-recipient", None, int),
+            # messages from the remote messenger
+            Event("peer-connected", int, None),
+            Event("peer-disconnected", int),
+            Command("deliver", bytes, int))
+    
+    def cleanup(self, state):
+        try:
+            self._closeConnection(state)
+            if state.bindAddr is not None:
+                del MemoryMessenger.listeners[state.bindAddr]
+        finally:
+            super(MemoryMessenger, self).cleanup(state)
+    
+    def doListen(self, m, bindAddr, family, senderPid, state):
+        if (state.bindAddr is not None) or (bindAddr in MemoryMessenger.listeners):
+            Process.send(senderPid, Event("listen-error", "invalid-state"))
+            return
+        state.logger.info("Listening to incoming connections on %s.", repr(bindAddr))
+        MemoryMessenger.listeners[bindAddr] = self.pid
+        state.bindAddr = bindAddr
+        self.listening(bindAddr)
+    
+    def doAccept(self, m, senderPid, state):
+        if state.isConnected or (state.bindAddr is None):
+            Process.send(senderPid, Event("accept-error", "invalid-state"))
+        else:
+            state.acceptingPid = senderPid
+    
+    def doConnect(self, m, remoteAddr, family, senderPid, state):
+        peerPid = MemoryMessenger.listeners.get(remoteAddr)
+        if state.isConnected:
+            Process.send(senderPid, Event("connection-error", "invalid-state"))
+        elif peerPid is None:
+            Process.send(senderPid, Event("connection-error", "connection-refused"))
+        else:
+            Process.send(peerPid, Event("peer-connected", self.pid, state.bindAddr))
+            state.senderPid = senderPid
+            self._connectionEstablished(peerPid, remoteAddr, state)
+    
+    def onPeerConnected(self, m, peerPid, remoteAddr, state):
+        if state.isConnected or (state.acceptingPid is None):
+            state.logger.info("Dropping connection from %s.", repr(remoteAddr))
+            Process.try_send(peerPid, Event("peer-disconnected", self.pid))
+        else:
+            state.senderPid, state.acceptingPid = state.acceptingPid, None
+            self._connectionEstablished(peerPid, remoteAddr, state)
+    
+    def _connectionEstablished(self, peerPid, remoteAddr, state):
+        state.logger.info("Connected to %s.", repr(remoteAddr))
+        state.isConnected = True
+        state.peerPid = peerPid
+        state.remoteAddr = remoteAddr
+        self.connected(remoteAddr)
+        self.protocolNegociated(VERSION_ALPHA)
+    
+    def onPeerDisconnected(self, m, peerPid, state):
+        if peerPid == state.peerPid:
+            state.peerPid = None
+            self._closeConnection(state)
+    
+    def doDisconnect(self, m, state):
+        self._closeConnection(state)
+    
+    def _closeConnection(self, state):
+        if state.isConnected:
+            if state.peerPid is not None:
+                # after the messages that were delivered to the peer
+                Process.try_send(state.peerPid, Event("peer-disconnected", self.pid), BULK_LANE)
+            state.logger.info("Disconnected from %s." % repr(state.remoteAddr))
+            state.isConnected = False
+            state.peerPid = None
+            state.remoteAddr = None
+            state.routes = []
+            self.disconnected()
+    
+    def doSend(self, m, message, senderPid, state):
+        if not state.isConnected:
+            Process.send(senderPid, Event("send-error", "invalid-state", message))
+            return
+        # the remote messenger might have stopped without notifying us yet
+        Process.try_send(state.peerPid, Command("deliver", message.to_bytes(), self.pid), BULK_LANE)
+    
+    def doDeliver(self, m, data, peerPid, state):
+        """ Deliver the message sent by the remote messenger to the right recipient. """
+        if peerPid != state.peerPid:
+            return
+        message = state.reader.parse(b" " + data)
+        routeRemoteMessage(message, state.routes, state.senderPid)
+    
+    def doAddRecipient(self, m, pattern, pid, state):
+        state.routes.insert(0, (compile_pattern(pattern), pid))
@@ -25,20 +25,35 @@ from struct import Struct
 __all__ = ["Message", "TextMessage", "Request", "Response", "Notification", "Blob", "Block", "formatMessage"]
 
 class Message(object):
+    __slots__ = ()
+    
     def to_bytes(self):
         """ Returns the canonical representation of the message, as bytes. """
         raise NotImplementedError()
 
-class TextMessage(Message, Sequence):
+class TextMessage(Message):
     REQUEST = ">"
     RESPONSE = "<"
     NOTIFICATION = "!"
+    # the items (class name, tag, transaction ID and params) are stored in a tuple
+    # which makes indexing and slicing cheap
+    __slots__ = ("type", "_items")
     
     def __init__(self, type, tag, transID, *params):
         self.type = type
-        self.tag = tag
-        self.transID = transID
-        self.params = params
+        self._items = (self.__class__.__name__, tag, transID) + params
+    
+    @property
+    def tag(self):
+        return self._items[1]
+    
+    @property
+    def transID(self):
+        return self._items[2]
+    
+    @property
+    def params(self):
+        return self._items[3:]
     
     def to_bytes(self):
         return u" ".join([self.type, self.tag, str(self.transID),
@@ -46,50 +61,52 @@ class TextMessage(Message, Sequence):
     
     def withID(self, transID):
         """ Set the message's transaction ID. """
-        self.transID = transID
+        items = self._items
+        self._items = items[:2] + (transID, ) + items[3:]
         return self
     
     def __len__(self):
-        return 3 + len(self.params)
+        return len(self._items)
     
     def __getitem__(self, index):
-        if isinstance(index, slice):
-            return tuple(self)[index]
-        elif index == 0:
-            return self.__class__.__name__
-        elif index == 1:
-            return self.tag
-        elif index == 2:
-            return self.transID
-        elif (index >= 3) and (index < (len(self.params) + 3)):
-            return self.params[index - 3]
-        else:
-            raise IndexError("Index '%i' out of range" % index)
+        return self._items[index]
+    
+    def __iter__(self):
+        return iter(self._items)
     
     def __repr__(self):
-        return repr(self[:])
+        return repr(self._items)
     
 class Request(TextMessage):
+    __slots__ = ()
+    
     def __init__(self, tag, *params):
         super(Request, self).__init__(TextMessage.REQUEST, tag, None, *params)
 
 class Response(TextMessage):
+    __slots__ = ()
+    
     def __init__(self, tag, *params):
         super(Response, self).__init__(TextMessage.RESPONSE, tag, None, *params)
 
 class Notification(TextMessage):
+    __slots__ = ()
+    
     def __init__(self, tag, *params):
         super(Notification, self).__init__(TextMessage.NOTIFICATION, tag, None, *params)
 
-class Blob(Message, Sequence):
+class Blob(Message):
     Type = Struct("BB")
+    # like TextMessage, the items (class name and params) are stored in a tuple
+    __slots__ = ("_items", )
     
-    def __init__(self):
+    def __init__(self, *params):
         super(Blob, self).__init__()
+        self._items = (self.__class__.__name__, ) + params
     
     @property
     def params(self):
-        raise NotImplementedError()
+        return self._items[1:]
     
     @property
     def data(self):
@@ -101,42 +118,52 @@ class Blob(Message, Sequence):
         return bytes().join([cls.Type.pack(0, cls.ID), data])
     
     def __len__(self):
-        return 1 + len(self.params)
+        return len(self._items)
     
     def __getitem__(self, index):
-        cls = self.__class__
-        if isinstance(index, slice):
-            return tuple(self)[index]
-        elif index == 0:
-            return cls.__name__
-        else:
-            params = self.params
-            if index < (len(params) + 1):
-                return params[index - 1]
-            else:
-                raise IndexError("Index '%i' out of range" % index)
+        return self._items[index]
+    
+    def __iter__(self):
+        return iter(self._items)
     
     def __repr__(self):
-        return repr(self[:])
+        return repr(self._items)
+
+# messages don't inherit from Sequence, which would give them a __dict__
+Sequence.register(TextMessage)
+Sequence.register(Blob)
 
 class Block(Blob):
     Header = Struct("!HIH")
     ID = 1
+    __slots__ = ()
     
     def __init__(self, transferID=None, blockID=None, blockData=None):
-        super(Block, self).__init__()
-        self.transferID = transferID
-        self.blockID = blockID
-        self.blockData = blockData
+        # blocks are created for every chunk of a file, so don't call Blob.__init__
+        self._items = (self.__class__.__name__, transferID, blockID, blockData)
     
     @property
-    def params(self):
-        return (self.transferID, self.blockID, self.blockData)
+    def transferID(self):
+        return self._items[1]
+    
+    @property
+    def blockID(self):
+        return self._items[2]
+    
+    @property
+    def blockData(self):
+        return self._items[3]
+    
+    @property
+    def payloadSize(self):
+        # blocks used as patterns have no data
+        blockData = self._items[3]
+        return len(blockData) if blockData is not None else 0
     
     @property
     def data(self):
-        return Block.Header.pack(self.transferID, self.blockID,
-                                 len(self.blockData)) + self.blockData
+        transferID, blockID, blockData = self._items[1:]
+        return Block.Header.pack(transferID, blockID, len(blockData)) + blockData
 
 def _serializable(obj):
     if hasattr(obj, "__getstate__"):
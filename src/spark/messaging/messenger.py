@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009, 2010 Pierre-André Saulais <pasaulais@free.fr>
+#
+# This file is part of the Spark File-transfer Tool.
+#
+# Spark is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Spark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spark; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+""" Behaviour shared by the processes that send and receive messages, whatever the transport. """
+
+from spark.core import *
+
+__all__ = ["MessengerMixin"]
+
+class MessengerMixin(object):
+    """
+    Tuning and lanes shared by TcpMessenger and MemoryMessenger. It must come before
+    the process class in the bases, and the 'disconnected' event sender must exist
+    once the base classes are initialized.
+    """
+    # none of the handlers read the queue, so messages can be dispatched in batches
+    batchSize = 16
+    # producers blocked by a full queue are notified once it is three-quarters empty
+    lowWatermark = 16
+    # outgoing blocks use at most 4 MiB, whatever the block size
+    queueBytes = 4 * 1024 * 1024
+    lowWatermarkBytes = 1024 * 1024
+    # stopping doesn't overtake outgoing messages
+    stopLane = BULK_LANE
+    
+    def __init__(self):
+        super(MessengerMixin, self).__init__()
+        self.protocolNegociated = EventSender("protocol-negociated", basestring)
+        # don't overtake the remote messages delivered before the connection was closed
+        self.disconnected.lane = BULK_LANE
+    
+    def send(self, message, senderPid=None):
+        if not senderPid:
+            senderPid = Process.current()
+        # all outgoing messages use the bulk lane, so that they are sent in the order they were queued
+        Process.send(self.pid, Command("send", message, senderPid), BULK_LANE)
+    
+    def disconnect(self):
+        # use the same lane as send(), so that the messages sent before go out first
+        Process.send(self.pid, Command("disconnect"), BULK_LANE)
+    
+    def addRecipient(self, pattern, pid):
+        """ Add a recipient to the message delivery table.
+        All messages matching the pattern will be sent to the process 'pid'. """
+        Process.send(self.pid, Command("add-recipient", pattern, pid))
+
+def routeRemoteMessage(m, routes, defaultPid):
+    """ Send a message received from the remote peer to the first route matching it,
+    or to 'defaultPid' if none does. """
+    recipient = defaultPid
+    if routes:
+        for matches, pid in routes:
+            if matches(m):
+                recipient = pid
+                break
+    # remote messages have to be delivered in the order they were received
+    Process.send(recipient, m, BULK_LANE)
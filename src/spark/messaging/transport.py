@@ -23,20 +23,15 @@ import socket
 from spark.core import *
 from spark.messaging.protocol import *
 from spark.messaging.messages import *
+from spark.messaging.messenger import MessengerMixin, routeRemoteMessage
 
 __all__ = ["TcpMessenger", "Service"]
 
-class TcpMessenger(TcpSocket):
+class TcpMessenger(MessengerMixin, TcpSocket):
     """ Process that can send and receive messages using a socket. """
-    def __init__(self):
-        super(TcpMessenger, self).__init__()
-        self.protocolNegociated = EventSender("protocol-negociated", basestring)
+    # sending blocks when the socket's buffer is full
+    dedicatedThread = True
     
-    def send(self, message, senderPid=None):
-        if not senderPid:
-            senderPid = Process.current()
-        Process.send(self.pid, Command("send", message, senderPid))
-
     def initState(self, state):
         super(TcpMessenger, self).initState(state)
         state.protocol = None
@@ -58,11 +53,6 @@ class TcpMessenger(TcpSocket):
         state.writer = messageWriter(stream, protocol)
         self.protocolNegociated(protocol)
     
-    def addRecipient(self, pattern, pid):
-        """ Add a recipient to the message delivery table.
-        All messages matching the pattern will be sent to the process 'pid'. """
-        Process.send(self.pid, Command("add-recipient", pattern, pid))
-    
     def doAddRecipient(self, m, pattern, pid, state):
         if state.receiver:
             Process.send(state.receiver.pid, m)
@@ -127,10 +117,10 @@ class TcpMessageReceiver(TcpReceiver):
                 if rm is None:
                     Process.exit()
                 self.deliverRemoteMessage(rm, state)
-                # check if the process has received any message while receiving from the socket
-                ok, lm = Process.try_receive()
-                if ok:
-                    self.handleMessage(lm, state)
+                # handle the messages the process has received while receiving from the socket
+                if Process.has_messages():
+                    for lm in Process.receive_batch(block=False):
+                        self.handleMessage(lm, state)
         except socket.error as e:
             if e.errno == 10058:
                 # shutdown() was called while waiting on recv()
@@ -144,18 +134,12 @@ class TcpMessageReceiver(TcpReceiver):
     
     def deliverRemoteMessage(self, m, state):
         """ Deliver the message we received from the socket to the right recipient. """
-        recipient = state.senderPid
-        if state.routes:
-            for pattern, pid in state.routes:
-                 if match(pattern, m):
-                    recipient = pid
-                    break
-        Process.send(recipient, m)
+        routeRemoteMessage(m, state.routes, state.senderPid)
     
     def doAddRecipient(self, m, pattern, pid, state):
         """ Add a recipient to the message delivery table.
         All messages matching the pattern will be sent to the process 'pid'. """
-        state.routes.insert(0, (pattern, pid))
+        state.routes.insert(0, (compile_pattern(pattern), pid))
 
 class SocketWrapper(object):
     def __init__(self, sock):
@@ -165,6 +149,9 @@ class SocketWrapper(object):
 
 class Service(ProcessBase):
     """ Base class for services that handle requests using messaging. """
+    # class of the process used to exchange messages with the remote peer
+    messengerClass = TcpMessenger
+    
     def __init__(self):
         super(Service, self).__init__()
         self.connected = EventSender("connected", None)
@@ -178,7 +165,7 @@ class Service(ProcessBase):
         state.bindAddr = None
         state.connAddr = None
         state.isConnected = False
-        state.messenger = TcpMessenger()
+        state.messenger = self.messengerClass()
         state.nextTransID = 1
     
     def initPatterns(self, loop, state):
@@ -21,8 +21,13 @@
 
 import unittest
 import threading
+import time
+import weakref
+from collections import Sequence
 from spark.core import *
 from spark.messaging import *
+from spark.core import aio
+from spark.core.process import NoMatchException, SaveQueue
 from spark.tests.common import run_tests, processTimeout, assertMatch, assertNoMatch
 
 class FutureTest(unittest.TestCase):
@@ -117,6 +122,82 @@ class FutureTest(unittest.TestCase):
         self.assertEqual(1, len(foo.result))
         self.assertEqual(("spam", "eggs"), foo.result[0])
     
+    def testSeveralCallbacks(self):
+        """ Every continuation should be invoked, in the order they were added """
+        result = []
+        f = Future()
+        f.after(lambda prev: result.append(1))
+        f.after(lambda prev, n: result.append(n), 2)
+        f.completed()
+        f.after(lambda prev: result.append(3))
+        self.assertEqual([1, 2, 3], result)
+    
+    def testRaisingCallback(self):
+        """ A callback raising an exception shouldn't prevent the other ones from being invoked """
+        result = []
+        def raising(*args):
+            raise KeyError("spam")
+        f = Future()
+        f.after(raising)
+        f.after(lambda prev: result.append(1))
+        f.on_cancel(raising)
+        f.on_cancel(result.append, 2)
+        f.cancel()
+        self.assertEqual([1, 2], result)
+    
+    def testAll(self):
+        """ Future.all should complete with every result, or fail with the first failure """
+        futures = [Future() for i in range(3)]
+        combined = Future.all(futures)
+        for i in (2, 0, 1):
+            self.assertTrue(combined.pending)
+            futures[i].completed(i * 10)
+        self.assertEqual([0, 10, 20], combined.result)
+        self.assertEqual([], Future.all([]).result)
+        futures = [Future() for i in range(2)]
+        combined = Future.all(futures)
+        futures[1].failed(KeyError("spam"))
+        self.assertRaises(TaskFailedError, combined.wait)
+        futures[0].completed()
+    
+    def testAny(self):
+        """ Future.any should complete with the first future to be done """
+        futures = [Future() for i in range(3)]
+        first = Future.any(futures)
+        futures[1].failed(KeyError("spam"))
+        futures[0].completed()
+        self.assertTrue(first.result is futures[1])
+        self.assertRaises(TaskFailedError, Future.any([]).wait, 0.0)
+    
+    def testWithTimeout(self):
+        """ with_timeout should fail the new future if the task isn't done in time """
+        f = Future()
+        try:
+            f.with_timeout(0.01).wait(1.0)
+        except TaskFailedError as e:
+            self.assertEqual(WaitTimeoutError, e.type)
+        else:
+            self.fail("wait() should have raised an exception")
+        limited = f.with_timeout(1.0)
+        f.completed("spam")
+        self.assertEqual("spam", limited.wait(0.5))
+        self.assertTrue(f.pending is False)
+        # the timer doesn't keep the future alive once the task is done
+        f = Future()
+        ref = weakref.ref(f.with_timeout(60.0))
+        f.completed()
+        self.assertTrue(ref() is None)
+    
+    def testMapThen(self):
+        """ map and then should chain functions and futures """
+        f = Future()
+        chained = f.map(lambda x: x + 1).then(lambda x: Future.done(x * 2)).map(str)
+        f.completed(1)
+        self.assertEqual("4", chained.result)
+        failed = Future.error(KeyError("spam")).map(lambda x: x + 1)
+        self.assertRaises(TaskFailedError, failed.wait)
+        self.assertEqual(2, Future.done(1).then(lambda x: x + 1).result)
+    
     def testRunCoroutine(self):
         readers = []
         writers = []
@@ -164,6 +245,20 @@ class FutureTest(unittest.TestCase):
         self.assertEqual(2, len(results))
         self.assertEqual("baz", results[1])
     
+    def testRunCoroutineDoneFutures(self):
+        """ Coroutines should be able to yield many futures which are already done without growing the stack """
+        def coroutine():
+            total = 0
+            for i in range(10000):
+                total += yield Future.done(i)
+            try:
+                yield Future.error(KeyError("spam"))
+            except TaskFailedError:
+                yield total
+        f = Future()
+        f.run_coroutine(coroutine())
+        self.assertEqual(49995000, f.result)
+    
     def testRunCoroutineHandledException(self):
         """ Exceptions raised by futures should look like as if they had been raised by 'yield'. """
         callers = []
@@ -205,6 +300,257 @@ class FutureTest(unittest.TestCase):
             pass
         else:
             self.fail("wait() should have raised an exception")
+    
+    def testCancelCoroutine(self):
+        """ Canceling a coroutine should cancel the task it waits for and raise inside it """
+        waited = Future()
+        canceled = []
+        def coroutine():
+            try:
+                yield waited
+            except TaskCanceledError:
+                canceled.append(True)
+                yield Future()
+        
+        f = Future()
+        f.run_coroutine(coroutine())
+        f.cancel()
+        self.assertRaises(TaskCanceledError, waited.wait)
+        self.assertEqual([True], canceled)
+        self.assertRaises(TaskCanceledError, f.wait)
+    
+    def testOnCancel(self):
+        """ on_cancel callbacks should only be invoked when the task is canceled """
+        calls = []
+        f = Future()
+        f.on_cancel(calls.append, 1)
+        f.completed()
+        f = Future()
+        f.on_cancel(calls.append, 2)
+        f.cancel()
+        f.on_cancel(calls.append, 3)
+        self.assertEqual([2, 3], calls)
+        inner = Future()
+        chained = Future.done(None).then(lambda x: inner)
+        chained.cancel()
+        self.assertRaises(TaskCanceledError, inner.wait)
+
+class Listener(object):
+    def __init__(self):
+        self.calls = []
+    
+    def notify(self, value):
+        self.calls.append(value)
+
+class DelegateTest(unittest.TestCase):
+    def testAddRemove(self):
+        """ Delegates should call functions in order, and removing one should not affect a call in progress """
+        d = Delegate()
+        calls = []
+        def first(value):
+            calls.append(("first", value))
+            d.__isub__(second)
+        def second(value):
+            calls.append(("second", value))
+        d += first
+        d += second
+        self.assertEqual(None, d(1))
+        self.assertEqual([("first", 1), ("second", 1)], calls)
+        d -= first
+        self.assertEqual([], d.collect(2))
+        d += second
+        self.assertEqual([None], d.collect(3))
+    
+    def testWeakMethods(self):
+        """ Weak delegates should not keep the objects of bound methods alive """
+        d = Delegate(weak=True)
+        listener, other = Listener(), Listener()
+        d += listener.notify
+        d += other.notify
+        d(1)
+        self.assertEqual([1], listener.calls)
+        d -= other.notify
+        del listener
+        self.assertEqual([], d.collect(2))
+        self.assertEqual([1], other.calls)
+    
+    def testWeakMethodCollectedWithLockHeld(self):
+        """ An object collected while the delegate's lock is held shouldn't deadlock """
+        lock = threading.Lock()
+        d = Delegate(lock, weak=True)
+        listener = Listener()
+        d += listener.notify
+        with lock:
+            del listener
+        other = Listener()
+        d += other.notify
+        self.assertEqual([None], d.collect(1))
+        self.assertEqual(1, len(d._Delegate__delegates))
+
+class BlockingQueueTest(unittest.TestCase):
+    def testOrder(self):
+        """ Items should be retrieved in the order they were inserted """
+        q = BlockingQueue(4)
+        for item in ("foo", "bar", "baz"):
+            q.put(item)
+        self.assertEqual(["foo", "bar", "baz"], list(q.iter_nowait()))
+        self.assertEqual((False, None), q.get_unless_empty())
+    
+    def testPutWaitsWhenFull(self):
+        """ put() should block until a consumer makes room in the queue """
+        q = BlockingQueue(1)
+        q.put("foo")
+        done = threading.Event()
+        def producer():
+            q.put("bar")
+            done.set()
+        t = threading.Thread(target=producer)
+        t.daemon = True
+        t.start()
+        self.assertFalse(done.wait(0.05))
+        self.assertEqual("foo", q.get())
+        self.assertTrue(done.wait(1.0))
+        self.assertEqual("bar", q.get())
+    
+    def testCloseWakesWaiters(self):
+        """ Threads blocked in get() should get an exception when the queue is closed """
+        q = BlockingQueue(1)
+        errors = []
+        def consumer():
+            try:
+                q.get()
+            except QueueClosedError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=consumer) for i in range(3)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        self.assertTrue(q.close())
+        for t in threads:
+            t.join(1.0)
+        self.assertEqual(3, len(errors))
+        self.assertFalse(q.isOpen)
+        self.assertFalse(q.close())
+    
+    def testCloseWaitEmpty(self):
+        """ close(waitEmpty=True) should let consumers read the remaining items """
+        q = BlockingQueue(4)
+        q.put("foo")
+        q.put("bar")
+        items = []
+        def consumer():
+            for item in q:
+                items.append(item)
+        t = threading.Thread(target=consumer)
+        t.daemon = True
+        t.start()
+        q.close(True)
+        t.join(1.0)
+        self.assertEqual(["foo", "bar"], items)
+        self.assertRaises(QueueClosedError, q.put, "baz")
+    
+    def testPutManyDrain(self):
+        """ put_many() should wait for room when the queue is full, and drain() should keep the order """
+        q = BlockingQueue(3)
+        def producer():
+            q.put_many(range(10))
+        t = threading.Thread(target=producer)
+        t.daemon = True
+        t.start()
+        items = []
+        while len(items) < 10:
+            batch = q.drain(2)
+            self.assertTrue(1 <= len(batch) <= 2)
+            items.extend(batch)
+        t.join(1.0)
+        self.assertEqual(range(10), items)
+        self.assertEqual([], q.drain(block=False))
+    
+    def testLanes(self):
+        """ Items in the first lanes should be retrieved first, in FIFO order within a lane """
+        q = BlockingQueue(2, lanes=2)
+        q.put_many(["a", "b"], 1)
+        q.put("c", 0)
+        q.put("d", 0)
+        self.assertEqual(4, q.pending)
+        self.assertEqual(2, q.pendingIn(1))
+        self.assertEqual("c", q.get())
+        self.assertEqual(["d", "a"], q.drain(2))
+        q.put("e", 1)
+        self.assertEqual(["b", "e"], q.drain())
+    
+    def testPutTimeout(self):
+        """ Putting items in a full lane should give up after the timeout """
+        q = BlockingQueue(2, lanes=2)
+        self.assertEqual(2, q.put_many(["a", "b", "c"], 1, 0))
+        self.assertRaises(WaitTimeoutError, q.put, "c", 1, 0.01)
+        q.put("d", 0, 0)
+        self.assertEqual(["d", "a", "b"], q.drain())
+    
+    def testByteBudget(self):
+        """ A lane should be full when the weight of its items reaches the budget, but hold at least one item """
+        q = BlockingQueue(None, lanes=2, byteBudget=10, weigh=len)
+        self.assertEqual(2, q.put_many(["aaaa", "bbbbbb", "c"], 1, 0))
+        self.assertEqual(10, q.bytesIn(1))
+        self.assertRaises(WaitTimeoutError, q.put, "c", 1, 0)
+        q.put("dd", 0, 0)
+        self.assertEqual(["dd", "aaaa"], q.drain(2))
+        self.assertEqual(6, q.bytesIn(1))
+        q.put("cccccccc", 1, 0)
+        self.assertEqual(["bbbbbb", "cccccccc"], q.drain())
+        q.put("e" * 20, 1, 0)
+        self.assertEqual(20, q.bytesIn(1))
+    
+    def testStats(self):
+        """ The queue should count items in and out and keep track of its high-water mark """
+        q = BlockingQueue(4, lanes=2)
+        self.assertEqual(None, q.stats())
+        q.put("a")
+        q.trackStats()
+        q.put_many(["b", "c"], 1)
+        q.put("d")
+        self.assertEqual("a", q.get())
+        self.assertEqual(["d", "b"], q.drain(2))
+        stats = q.stats()
+        self.assertEqual(1, stats["depth"])
+        self.assertEqual(4, stats["highWater"])
+        self.assertEqual((3, 3), (stats["in"], stats["out"]))
+        self.assertEqual(3, sum(count for bound, count in stats["latency"]))
+        q.trackStats(False)
+        self.assertEqual(None, q.stats())
+    
+    def testGetTimeout(self):
+        """ get() should raise WaitTimeoutError if no item was put before the timeout """
+        q = BlockingQueue(1)
+        self.assertEqual(0, q.pending)
+        self.assertRaises(WaitTimeoutError, q.get, 0.01)
+        q.put("foo")
+        self.assertEqual(1, q.pending)
+        self.assertEqual("foo", q.get(0.01))
+    
+    def testManyProducersConsumers(self):
+        """ Every item put by several producers should be received exactly once """
+        q = BlockingQueue(2)
+        received = []
+        lock = threading.Lock()
+        def producer(start):
+            for i in range(start, start + 100):
+                q.put(i)
+        def consumer():
+            for item in q:
+                with lock:
+                    received.append(item)
+        consumers = [threading.Thread(target=consumer) for i in range(3)]
+        producers = [threading.Thread(target=producer, args=(i * 100, )) for i in range(4)]
+        for t in consumers + producers:
+            t.daemon = True
+            t.start()
+        for t in producers:
+            t.join(5.0)
+        q.close(True)
+        for t in consumers:
+            t.join(5.0)
+        self.assertEqual(range(400), sorted(received))
 
 class ProcessTest(unittest.TestCase):
     @processTimeout(1.0)
@@ -245,6 +591,170 @@ class ProcessTest(unittest.TestCase):
         Process.send(p, None)
         self.assertEqual(["foo", "bar", "baz"], Process.receive())
     
+    @processTimeout(1.0)
+    def testSendManyReceiveBatch(self):
+        """ Messages sent with Process.send_many should be received in order by Process.receive_batch """
+        pid = Process.current()
+        def entry():
+            messages = []
+            while len(messages) < 3:
+                messages.extend(Process.receive_batch(2))
+            Process.send(pid, messages)
+        p = Process.spawn(entry)
+        Process.send_many(p, ["foo", "bar", "baz"])
+        self.assertEqual(["foo", "bar", "baz"], Process.receive())
+        self.assertEqual([], Process.receive_batch(block=False))
+    
+    @processTimeout(1.0)
+    def testSendLanes(self):
+        """ Messages sent in the control lane should be received before bulk messages """
+        pid = Process.current()
+        sent = Future()
+        def entry():
+            sent.wait(1.0)
+            Process.send(pid, Process.receive_batch())
+        p = Process.spawn(entry)
+        Process.send_many(p, ["bulk1", "bulk2"], BULK_LANE)
+        Process.send(p, "control")
+        sent.completed()
+        self.assertEqual(["control", "bulk1", "bulk2"], Process.receive())
+    
+    @processTimeout(1.0)
+    def testBackpressure(self):
+        """ Sending to a full lane with a timeout should fail, and the process should tell when it drained """
+        gate = Future()
+        class Sink(ProcessBase):
+            dedicatedThread = True
+            lowWatermark = 0
+            def initPatterns(self, loop, state):
+                super(Sink, self).initPatterns(loop, state)
+                loop.addPattern(basestring, lambda m, state: gate.wait(1.0))
+        sink = Sink()
+        sink.start()
+        try:
+            Process.send(sink.pid, "first", BULK_LANE)
+            messages = ["m%i" % i for i in range(Process.queueSize + 1)]
+            sent = Process.send_many(sink.pid, messages, BULK_LANE, 0.1)
+            self.assertEqual(Process.queueSize, sent)
+            self.assertFalse(Process.try_send(sink.pid, "last", BULK_LANE, 0))
+            self.assertRaises(WaitTimeoutError, Process.send, sink.pid, "last", BULK_LANE, 0.01)
+            Process.send(sink.pid, Command("notify-drained", Process.current()))
+            gate.completed()
+            self.assertEqual(["Event", "drained", sink.pid], list(Process.receive()))
+        finally:
+            sink.stop()
+    
+    @processTimeout(1.0)
+    def testQueueCapacity(self):
+        """ Processes should be spawned with the queue capacity they ask for """
+        gate = Future()
+        class Sink(ProcessBase):
+            queueSize = 2
+            queueBytes = 100
+            def initPatterns(self, loop, state):
+                super(Sink, self).initPatterns(loop, state)
+                loop.addPattern(basestring, lambda m, state: gate.wait(1.0))
+                loop.addPattern(Command("send", Block), lambda m, state: None)
+        sink = Sink()
+        sink.start()
+        try:
+            Process.send(sink.pid, "first", BULK_LANE)
+            self.assertEqual(2, Process.send_many(sink.pid, ["a", "b", "c"], BULK_LANE, 0.1))
+            block = Command("send", Block(1, 2, "x" * 100))
+            self.assertEqual(100, payload_size(block))
+            self.assertTrue(Process.try_send(sink.pid, block, CONTROL_LANE, 0))
+            self.assertFalse(Process.try_send(sink.pid, block, CONTROL_LANE, 0))
+        finally:
+            gate.completed()
+            sink.stop()
+        hold = Future()
+        pid = Process.spawn(hold.wait, (1.0, ), queueSize=1)
+        try:
+            self.assertTrue(Process.try_send(pid, "a", BULK_LANE, 0))
+            self.assertFalse(Process.try_send(pid, "b", BULK_LANE, 0))
+        finally:
+            hold.completed()
+    
+    @processTimeout(1.0)
+    def testReceiveTimeout(self):
+        """ Process.receive should give up after the timeout, and has_messages should tell when not to block """
+        self.assertFalse(Process.has_messages())
+        self.assertRaises(WaitTimeoutError, Process.receive, None, 0.01)
+        Process.send(Process.current(), "foo")
+        self.assertTrue(Process.has_messages())
+        self.assertEqual("foo", Process.receive(timeout=0.01))
+    
+    @processTimeout(1.0)
+    def testSelectiveReceive(self):
+        """ Process.receive(pattern) should return the first matching message and keep the other ones in order """
+        pid = Process.current()
+        Process.send(pid, Event("foo", 1))
+        Process.send(pid, Command("bar", 2))
+        Process.send(pid, "baz")
+        Process.send(pid, Command("bar", 3))
+        self.assertEqual(Command("bar", 3)[:], Process.receive(Command("bar", 3))[:])
+        self.assertEqual("baz", Process.receive(basestring))
+        self.assertRaises(WaitTimeoutError, Process.receive, Event("qux"), 0.01)
+        self.assertTrue(Process.has_messages())
+        self.assertEqual(Command("bar", 2)[:], Process.receive(Command("bar", int))[:])
+        Process.send(pid, Event("qux"))
+        self.assertEqual(["Event", "foo", 1], list(Process.receive()))
+        self.assertEqual([["Event", "qux"]], [list(m) for m in Process.receive_batch()])
+        self.assertFalse(Process.has_messages())
+    
+    def testSaveQueueRemovesTaken(self):
+        """ Messages taken from the save queue should be removed from its index too """
+        saved = SaveQueue()
+        saved.add(Event("junk"))
+        matches = compile_pattern(Command("ping", int))
+        for i in range(1000):
+            saved.add(Command("ping", i))
+            found, m = saved.take(matches, ("Command", "ping"))
+            self.assertEqual((True, i), (found, m[2]))
+        self.assertEqual(1, len(saved))
+        self.assertEqual({("Event", "junk"): 1}, dict((k, len(v)) for k, v in saved.index.items()))
+        saved.add(Command("pong", 1))
+        found, m = saved.take(compile_pattern([None, "pong", None]), None)
+        self.assertEqual((True, "pong"), (found, m[1]))
+        self.assertEqual(1, len(saved.index))
+        self.assertEqual("junk", saved.pop()[1])
+        self.assertEqual({}, saved.index)
+    
+    @processTimeout(1.0)
+    def testStats(self):
+        """ Process.stats should return the statistics of the process' queue once enabled """
+        pid = Process.current()
+        self.assertEqual(None, Process.stats())
+        Process.track_stats()
+        try:
+            Process.send(pid, "foo")
+            self.assertEqual("foo", Process.receive())
+            stats = Process.stats(pid)
+            self.assertEqual(pid, stats["pid"])
+            self.assertEqual((1, 1, 0), (stats["in"], stats["out"], stats["depth"]))
+        finally:
+            Process.track_stats(False)
+    
+    @processTimeout(1.0)
+    def testExitedProcessRemoved(self):
+        """ Processes should be removed from the registry when they exit """
+        Process.trap_exit()
+        pid = Process.spawn_linked(lambda: None)
+        assertMatch(Event("exit", pid, None), Process.receive())
+        self.assertFalse(pid in Process.all())
+        self.assertFalse(Process.try_send(pid, "foo"))
+        self.assertRaises(ProcessExited, Process.send, pid, "foo")
+    
+    @processTimeout(1.0)
+    def testSendCachedExited(self):
+        """ Sending to a process that exited should fail even if its queue was cached """
+        Process.trap_exit()
+        pid = Process.spawn_linked(Process.receive)
+        Process.send(pid, "foo")
+        assertMatch(Event("exit", pid, None), Process.receive())
+        self.assertFalse(Process.try_send(pid, "bar"))
+        self.assertFalse(Process.try_send(pid, "baz"))
+    
     def testAttach(self):
         """ Threads that have been attached should be able to receive messages """
         cont = Future()
@@ -260,6 +770,353 @@ class ProcessTest(unittest.TestCase):
         t.start()
         self.assertEqual("foo", cont.wait(1.0))
 
+class EchoProcess(ProcessBase):
+    def initPatterns(self, loop, state):
+        super(EchoProcess, self).initPatterns(loop, state)
+        loop.addHandlers(self, Command("echo", None, int))
+    
+    def doEcho(self, m, value, senderPid, state):
+        Process.send(senderPid, Event("echo", value, threading.current_thread().name))
+
+class FloodProcess(ProcessBase):
+    """ Sends many messages at once to another process, then tells the caller. """
+    def initPatterns(self, loop, state):
+        super(FloodProcess, self).initPatterns(loop, state)
+        loop.addHandlers(self, Command("flood", int, int, int))
+    
+    def doFlood(self, m, targetPid, count, senderPid, state):
+        for i in range(count):
+            Process.send(targetPid, Command("count", i))
+        Process.send(targetPid, Command("report", senderPid))
+
+class CountProcess(ProcessBase):
+    def initState(self, state):
+        super(CountProcess, self).initState(state)
+        state.received = []
+    
+    def initPatterns(self, loop, state):
+        super(CountProcess, self).initPatterns(loop, state)
+        loop.addHandlers(self, Command("count", int), Command("report", int))
+    
+    def doCount(self, m, i, state):
+        state.received.append(i)
+    
+    def doReport(self, m, senderPid, state):
+        Process.send(senderPid, Event("received", state.received))
+
+class WorkerPoolTest(unittest.TestCase):
+    def testSubmit(self):
+        """ Callables submitted to the pool should be executed by its threads """
+        pool = WorkerPool(2, "test")
+        results = BlockingQueue(None)
+        for i in range(10):
+            pool.submit(results.put, i)
+        pool.shutdown()
+        self.assertEqual(range(10), sorted(results.drain(block=False)))
+    
+    def testBoundedQueue(self):
+        """ Pools with a bounded queue should reject callables when it is full, and count them """
+        pool = WorkerPool(1, "test-bounded", maxQueued=1)
+        gate = Future()
+        started = Future()
+        pool.submit(lambda: started.completed() or gate.wait(1.0))
+        started.wait(1.0)
+        pool.submit(gate.wait, 1.0)
+        self.assertRaises(TaskRejectedError, pool.submit, gate.wait, 1.0)
+        stats = pool.stats()
+        self.assertEqual((1, 1, 0, 1), (stats["queued"], stats["running"],
+            stats["completed"], stats["rejected"]))
+        gate.completed()
+        pool.shutdown()
+        self.assertEqual(2, pool.stats()["completed"])
+        # a rejected slice would leave the process unable to run
+        p = EchoProcess()
+        p.pool = WorkerPool(1, "test-bounded", maxQueued=1)
+        self.assertRaises(ValueError, p.start)
+        self.assertEqual(None, p.pid)
+    
+    def testThreadedMethod(self):
+        """ threadedMethod should run the function on the given pool and complete the future """
+        pool = WorkerPool(1, "test-threaded")
+        @threadedMethod(pool=pool)
+        def whichThread(suffix):
+            return threading.current_thread().name + suffix
+        self.assertEqual("test-threaded-1!", whichThread("!").wait(1.0))
+        pool.shutdown()
+        self.assertRaises(TaskFailedError, whichThread("!").wait, 1.0)
+        @threadedMethod
+        def add(a, b=0):
+            return a + b
+        self.assertEqual(3, add(1, b=2).wait(1.0))
+        self.assertTrue(WorkerPool.named("threaded") is WorkerPool.named("threaded"))
+    
+    def testCancelableThreadedMethod(self):
+        """ Canceling the future of a cancelable threadedMethod should set its token """
+        pool = WorkerPool(1, "test-cancel")
+        started = threading.Event()
+        @threadedMethod(pool=pool, cancelable=True)
+        def spin(token):
+            started.set()
+            while True:
+                token.check()
+                time.sleep(0.01)
+        f = spin()
+        self.assertTrue(started.wait(1.0))
+        f.cancel()
+        pool.shutdown()
+        self.assertEqual(0, pool.stats()["running"])
+    
+    @processTimeout(1.0)
+    def testPooledProcesses(self):
+        """ Processes should be able to run on a worker pool, using only its threads """
+        pool = WorkerPool(2, "test-pool")
+        processes = [EchoProcess() for i in range(10)]
+        for i, p in enumerate(processes):
+            p.pool = pool
+            p.start()
+            Process.send(p.pid, Command("echo", i, Process.current()))
+        replies = [Process.receive() for p in processes]
+        self.assertEqual(range(10), sorted(r[2] for r in replies))
+        self.assertTrue(set(r[3] for r in replies) <= set(["test-pool-1", "test-pool-2"]))
+        for p in processes:
+            p.stop()
+        pool.shutdown()
+    
+    @processTimeout(5.0)
+    def testPooledSendToFullQueue(self):
+        """ Processes sending to a full queue should not block the threads of the pool """
+        pool = WorkerPool(1, "test-full")
+        source, sink = FloodProcess(), CountProcess()
+        for p in (source, sink):
+            p.pool = pool
+            p.queueSize = 16
+            p.start()
+        Process.send(source.pid, Command("flood", sink.pid, 200, Process.current()))
+        assertMatch(Event("received", range(200)), Process.receive())
+        source.stop()
+        sink.stop()
+        pool.shutdown()
+    
+    @processTimeout(1.0)
+    def testPooledProcessLinked(self):
+        """ Linked processes running on a worker pool should notify their exit """
+        Process.trap_exit()
+        p = EchoProcess()
+        p.pool = WorkerPool(1, "test-link")
+        pid = p.start_linked()
+        p.stop()
+        assertMatch(Event("exit", pid, None), Process.receive())
+        p = EchoProcess()
+        p.pool = WorkerPool(1, "test-kill")
+        pid = p.start_linked()
+        Process.kill(pid, False)
+        assertMatch(Event("exit", pid, "killed"), Process.receive())
+        self.assertFalse(Process.try_send(pid, Command("echo", 1, Process.current())))
+
+def square(x):
+    return x * x
+
+def divide(x, y):
+    return x / y
+
+class OffloadPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = OffloadPool(1, "test-offload")
+    
+    def tearDown(self):
+        self.pool.shutdown()
+    
+    def testSubmit(self):
+        """ Callables submitted to the pool should run in worker processes and complete their future """
+        self.assertEqual(49, self.pool.submit(square, 7).wait(5.0))
+        f = self.pool.submit(divide, 1, 0)
+        try:
+            f.wait(5.0)
+        except TaskFailedError as e:
+            self.assertEqual(ZeroDivisionError, e.type)
+        else:
+            self.fail("wait() should have raised an exception")
+    
+    def testCancel(self):
+        """ Callables should wait for a free worker, and not run if their future was canceled """
+        f1 = self.pool.submit(time.sleep, 0.1)
+        f2 = self.pool.submit(square, 2)
+        f3 = self.pool.submit(square, 3)
+        self.assertEqual(3, self.pool.pending)
+        f2.cancel()
+        self.assertEqual(9, f3.wait(5.0))
+        self.assertFalse(f1.pending)
+        self.assertRaises(TaskCanceledError, f2.wait)
+        self.assertEqual(0, self.pool.pending)
+    
+    @processTimeout(5.0)
+    def testSubmitEvent(self):
+        """ The result should be sent to the process which submitted the callable """
+        self.pool.submit_event("squared", square, 5)
+        m = Process.receive(Event("squared", Future))
+        self.assertEqual(25, m[2].result)
+    
+    @processTimeout(5.0)
+    def testSubmitEventToFullQueue(self):
+        """ A process whose queue is full shouldn't hold up the results of the other callables """
+        pid = Process.current()
+        done = Future()
+        def entry():
+            # fill the queue of the process, so that the event can't be sent
+            Process.send(Process.current(), "filler")
+            self.pool.submit_event("squared", square, 5)
+            Process.send(pid, self.pool.submit(square, 6).wait(4.0))
+            done.wait(4.0)
+        Process.spawn(entry, queueSize=1)
+        try:
+            self.assertEqual(36, Process.receive(timeout=4.0))
+        finally:
+            done.completed()
+
+@unittest.skipIf(aio.asyncio is None, "asyncio is not available")
+class AsyncioTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = aio.asyncio.new_event_loop()
+    
+    def tearDown(self):
+        self.loop.close()
+    
+    def runLoop(self, duration):
+        self.loop.run_until_complete(aio.asyncio.sleep(duration, loop=self.loop))
+    
+    def testFutureConversion(self):
+        """ Futures should be convertible to and from asyncio futures """
+        f = Future()
+        f.completed(5)
+        self.assertEqual(5, self.loop.run_until_complete(to_asyncio(f, self.loop)))
+        converted = aio.asyncio.Future(loop=self.loop)
+        g = from_asyncio(converted)
+        self.loop.call_soon(converted.set_exception, KeyError("spam"))
+        self.runLoop(0.01)
+        self.assertRaises(TaskFailedError, g.wait, 0.0)
+        f = Future()
+        to_asyncio(f, self.loop).cancel()
+        self.runLoop(0.01)
+        self.assertRaises(TaskCanceledError, f.wait, 0.0)
+    
+    @processTimeout(1.0)
+    def testPooledProcesses(self):
+        """ Processes should be able to run on the loop's thread """
+        pool = AsyncioPool(self.loop)
+        p = EchoProcess()
+        p.pool = pool
+        p.start()
+        Process.send(p.pid, Command("echo", 1, Process.current()))
+        self.runLoop(0.05)
+        reply = Process.receive(timeout=0.5)
+        self.assertEqual([1, threading.current_thread().name], list(reply[2:]))
+        p.stop()
+        self.runLoop(0.01)
+        pool.shutdown()
+    
+    @processTimeout(1.0)
+    def testSend(self):
+        """ Messages sent from the loop should wait for room in the queue without blocking the loop """
+        pool = AsyncioPool(self.loop)
+        hold = Future()
+        pid = Process.current()
+        def entry():
+            hold.wait(1.0)
+            Process.send(pid, [Process.receive(timeout=1.0) for i in range(3)])
+        p = Process.spawn(entry, queueSize=1)
+        for m in ("a", "b", "c"):
+            pool.send(p, m)
+        self.assertEqual(["b", "c"], list(pool.backlog[(p, CONTROL_LANE)]))
+        hold.completed()
+        self.runLoop(0.2)
+        self.assertEqual(["a", "b", "c"], Process.receive(timeout=0.5))
+        self.assertEqual({}, pool.backlog)
+    
+    @processTimeout(2.0)
+    def testProcessSend(self):
+        """ Processes running on the loop should not block it when sending to a full queue """
+        pool = AsyncioPool(self.loop)
+        hold = Future()
+        pid = Process.current()
+        def entry():
+            hold.wait(1.0)
+            Process.send(pid, [Process.receive(timeout=1.0)[2] for i in range(3)])
+        target = Process.spawn(entry, queueSize=1)
+        p = EchoProcess()
+        p.pool = pool
+        p.start()
+        for i in range(3):
+            Process.send(p.pid, Command("echo", i, target))
+        self.runLoop(0.05)
+        hold.completed()
+        self.runLoop(0.2)
+        self.assertEqual([0, 1, 2], Process.receive(timeout=0.5))
+        p.stop()
+        self.runLoop(0.01)
+        pool.shutdown()
+
+class PatternMatcherTest(unittest.TestCase):
+    def testLastAddedWins(self):
+        """ The pattern added last should win, whether it is indexed or not """
+        matcher = PatternMatcher()
+        matcher.addPattern(Command("foo", int), result="indexed1")
+        matcher.addPattern(Command(basestring, int), result="wildcard")
+        matcher.addPattern(Command("foo", None), result="indexed2")
+        matcher.addPattern(None, result="any")
+        bar = Command("bar", int)
+        matcher.addPattern(bar, result="indexed3")
+        self.assertEqual("indexed3", matcher.match(Command("bar", 1)))
+        self.assertEqual("any", matcher.match(Command("foo", 1)))
+        self.assertEqual("any", matcher.match("baz"))
+        matcher.removePattern(None, result="any")
+        self.assertEqual("indexed2", matcher.match(Command("foo", 1)))
+        matcher.removePattern(bar, result="indexed3")
+        self.assertEqual("wildcard", matcher.match(Command("bar", 1)))
+        self.assertRaises(NoMatchException, matcher.match, "baz")
+
+    def testAddHandler(self):
+        """ Handler methods should be resolved when added, and invoked with the message params """
+        class Handler(object):
+            def doFoo(self, m, a, b, state):
+                self.called = (a, b, state)
+        handler = Handler()
+        matcher = PatternMatcher()
+        matcher.addHandler(Command("foo", int, None), handler)
+        self.assertRaises(AttributeError, matcher.addHandler, Command("bar"), handler)
+        matcher.match(Command("foo", 1, "baz"), "state")
+        self.assertEqual((1, "baz", "state"), handler.called)
+
+    def testProfiler(self):
+        """ The profiler should count handler calls, and only time the sampled ones """
+        class Handler(object):
+            def doFoo(self, m, state):
+                pass
+        matcher = PatternMatcher("Handler")
+        matcher.addHandler(Command("foo"), Handler())
+        matcher.profiler = HandlerProfiler(sampleEvery=2)
+        for i in range(5):
+            matcher.match(Command("foo"), None)
+        stats = matcher.profiler.stats()
+        self.assertEqual(1, len(stats))
+        self.assertEqual(("Handler", "doFoo", 5, 3), (stats[0]["process"], stats[0]["handler"],
+            stats[0]["calls"], stats[0]["sampled"]))
+        self.assertTrue(stats[0]["wallMax"] >= 0.0)
+        # calls made on other threads are added up
+        t = threading.Thread(target=matcher.match, args=(Command("foo"), None))
+        t.start()
+        t.join()
+        row = matcher.profiler.stats()[0]
+        self.assertEqual((6, 4), (row["calls"], row["sampled"]))
+        # the table of the thread is merged once it has exited
+        for i in range(100):
+            if len(matcher.profiler.tables) == 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(1, len(matcher.profiler.tables))
+        row = matcher.profiler.stats()[0]
+        self.assertEqual((6, 4), (row["calls"], row["sampled"]))
+        self.assertRaises(ValueError, HandlerProfiler, 0)
+
 class EventSenderTest(unittest.TestCase):
     @processTimeout(1.0)
     def testSendEvent(self):
@@ -293,6 +1150,21 @@ class EventSenderTest(unittest.TestCase):
                 self.fail("Sent %s which doesn't match the pattern %s"
                     % (repr(event), repr(sender.pattern)))
 
+    @processTimeout(1.0)
+    def testSuscribers(self):
+        """ EventSender should keep each suscriber once and allow skipping validation """
+        ev = EventSender("foo", int)
+        pid = Process.current()
+        ev.suscribe()
+        ev.suscribe(pid)
+        self.assertEqual((pid, ), ev.suscribers)
+        ev.validate = False
+        ev("bar")
+        assertMatch(Event("foo", "bar"), Process.receive())
+        ev.unsuscribe()
+        self.assertEqual((), ev.suscribers)
+        self.assertRaises(KeyError, ev.unsuscribe)
+
 class ProcessMessageTest(unittest.TestCase):
     def testMessageAsSequence(self):
         c = Command('bind', '127.0.0.1:4550')
@@ -306,6 +1178,15 @@ class ProcessMessageTest(unittest.TestCase):
     def testComparingMessages(self):
         assertMatch(Command('foo'), Command('foo'))
         assertNoMatch(Command('foo'), Event('foo'))
+    
+    def testCompactMessages(self):
+        """ Messages should not have a __dict__, but should still be sequences only equal to themselves """
+        c = Command('bind', '127.0.0.1:4550')
+        self.assertFalse(hasattr(c, "__dict__"))
+        self.assertTrue(isinstance(c, Sequence))
+        self.assertNotEqual(Command('bind', '127.0.0.1:4550'), c)
+        self.assertEqual(('bind', '127.0.0.1:4550'), c[1:])
+        self.assertEqual(('127.0.0.1:4550', ), c.params)
 
 if __name__ == '__main__':
     run_tests()
\ No newline at end of file
@@ -44,6 +44,21 @@ class MessageMatchingTest(unittest.TestCase):
         assertNoMatch(Request("swap", "foo", "bar").withID(1), Request("swap"))
         assertNoMatch(('disconnect', ), Event("protocol-negociated", "SPARKv1"))
     
+    def testMappings(self):
+        """ match() should properly match dict patterns, ignoring extra keys """
+        assertMatch({"foo": int}, {"foo": 1, "bar": 2})
+        assertMatch(("foo", {"bar": None}), ("foo", {"bar": "baz"}))
+        assertNoMatch({"foo": int}, {"bar": 1})
+        assertNoMatch({"foo": int}, ("foo", 1))
+    
+    def testNone(self):
+        """ match() should match None against any pattern type, and any object against None """
+        assertMatch(None, ("foo", 1))
+        assertMatch(int, None)
+        assertMatch(int, int)
+        assertNoMatch(("foo", int), ("foo", 1, 2))
+        assertNoMatch(("foo", 1), ("foo", "1"))
+    
     def testMatchSubclass(self):
         """ match()  should match a type if it is one of its parent types """
         assertMatch(basestring, u"foo")
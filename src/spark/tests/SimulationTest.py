@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009, 2010 Pierre-André Saulais <pasaulais@free.fr>
+#
+# This file is part of the Spark File-transfer Tool.
+#
+# Spark is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Spark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spark; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import unittest
+import os
+import tempfile
+import shutil
+from spark.core import *
+from spark.messaging import *
+from spark.fileshare import *
+from spark.tests.common import run_tests, processTimeout, assertMatch
+
+class CounterProcess(ProcessBase):
+    def initState(self, state):
+        super(CounterProcess, self).initState(state)
+        state.count = 0
+    
+    def initPatterns(self, loop, state):
+        super(CounterProcess, self).initPatterns(loop, state)
+        loop.addHandlers(self, Command("increment", int), Command("report", int))
+    
+    def doIncrement(self, m, senderPid, state):
+        state.count += 1
+        Process.send(senderPid, Event("incremented", self.pid, state.count))
+    
+    def doReport(self, m, senderPid, state):
+        Process.send(senderPid, Event("count", state.count))
+
+class SimulationTest(unittest.TestCase):
+    def testTimers(self):
+        """ Timers should run in order of their deadline, advancing the virtual clock """
+        calls = []
+        sim = Simulation()
+        sim.call_later(2.0, lambda: calls.append(("b", sim.now())))
+        sim.call_later(1.0, lambda: calls.append(("a", sim.now())))
+        sim.call_later(2.0, lambda: calls.append(("c", sim.now())))
+        sim.submit(lambda: calls.append(("now", sim.now())))
+        self.assertEqual(2, sim.run(until=1.5))
+        self.assertEqual(1.5, sim.now())
+        self.assertEqual(2, sim.run())
+        self.assertEqual([("now", 0.0), ("a", 1.0), ("b", 2.0), ("c", 2.0)], calls)
+    
+    @processTimeout(5.0)
+    def testDeterministicOrder(self):
+        """ Processes should run on the current thread, in the same order every time """
+        def scenario():
+            with Simulation() as sim:
+                counters = [CounterProcess() for i in range(10)]
+                for counter in counters:
+                    counter.start()
+                for i in range(3):
+                    for counter in counters:
+                        Process.send(counter.pid, Command("increment", Process.current()))
+                sim.run()
+                pids = [counter.pid for counter in counters]
+                order = [pids.index(Process.receive(timeout=0.0)[2]) for i in range(30)]
+                for counter in counters:
+                    counter.stop()
+                sim.run()
+                return order
+        first = scenario()
+        self.assertEqual([i for i in range(10) for j in range(3)], first)
+        self.assertEqual(first, scenario())
+    
+    @processTimeout(5.0)
+    def testSendThenDisconnect(self):
+        """ Messages sent before disconnecting should be delivered before the peer is disconnected """
+        with Simulation() as sim:
+            a, b = MemoryMessenger(), MemoryMessenger()
+            a.start()
+            b.start()
+            b.disconnected.suscribe()
+            b.listen(("b", 4550))
+            b.accept()
+            sim.run()
+            a.connect(("b", 4550))
+            sim.run()
+            while Process.try_receive()[0]:
+                pass
+            a.send(Notification("bye").withID(1))
+            a.disconnect()
+            sim.run()
+            assertMatch(Notification("bye"), Process.receive(timeout=0.0))
+            assertMatch(Event("disconnected"), Process.receive(timeout=0.0))
+            self.assertFalse(Process.try_receive()[0])
+            a.stop()
+            b.stop()
+            sim.run()
+    
+    @processTimeout(10.0)
+    def testFileTransfer(self):
+        """ Two sessions connected in memory should be able to transfer a file """
+        folder = tempfile.mkdtemp()
+        try:
+            source, dest = os.path.join(folder, "source"), os.path.join(folder, "dest")
+            with open(source, "wb") as f:
+                f.write(os.urandom(100000))
+            with Simulation() as sim:
+                server, client = FileSharingSession(), FileSharingSession()
+                for session in (server, client):
+                    session.messengerClass = MemoryMessenger
+                    session.start()
+                client.fileListUpdated.suscribe()
+                Process.send(server.pid, Command("bind", ("server", 4550)))
+                Process.send(server.pid, Command("add-file", source, None, Process.current()))
+                sim.run()
+                Process.send(client.pid, Command("connect", ("server", 4550)))
+                sim.run()
+                Process.receive(Event("file-list-updated"), timeout=0.0)
+                Process.send(client.pid, Command("list-files", True, Process.current()))
+                sim.run()
+                files = Process.receive(Event("list-files", None), timeout=0.0)[2]
+                self.assertEqual(1, len(files))
+                Process.send(client.pid, Command("start-transfer", files.keys()[0], dest, Process.current()))
+                sim.run()
+                server.stop()
+                client.stop()
+                sim.run()
+            self.assertEqual(open(source, "rb").read(), open(dest, "rb").read())
+        finally:
+            shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    run_tests()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009, 2010 Pierre-André Saulais <pasaulais@free.fr>
+#
+# This file is part of the Spark File-transfer Tool.
+#
+# Spark is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Spark is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Spark; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+""" Long-running tests, which are not part of the default test suite. """
+
+import unittest
+import gc
+from spark.core import *
+from spark.tests.common import run_tests
+
+ProcessCount = 100000
+
+class ShortLivedProcess(ProcessBase):
+    pass
+
+class RegistrySoakTest(unittest.TestCase):
+    def runProcesses(self, spawnLinked, count):
+        """ Spawn processes one after another, waiting for each to exit. """
+        for i in xrange(count):
+            pid = spawnLinked()
+            m = Process.receive()
+            self.assertEqual(pid, m[2])
+    
+    def assertBoundedMemory(self, spawnLinked):
+        """ Running lots of processes shouldn't leave anything behind. """
+        pid = Process.attach("SoakTest")
+        try:
+            Process.trap_exit()
+            # warm up caches, thread pools, etc.
+            self.runProcesses(spawnLinked, 1000)
+            gc.collect()
+            objects = len(gc.get_objects())
+            self.runProcesses(spawnLinked, ProcessCount)
+            gc.collect()
+            self.assertEqual([pid], Process.all())
+            self.assertTrue(len(gc.get_objects()) - objects < 1000,
+                "%d objects were created and not freed" % (len(gc.get_objects()) - objects))
+        finally:
+            Process.detach()
+    
+    def testThreads(self):
+        """ Processes that ran on their own thread should be removed from the registry """
+        def spawnLinked():
+            return Process.spawn_linked(lambda: None)
+        self.assertBoundedMemory(spawnLinked)
+    
+    def testWorkerPool(self):
+        """ Processes that ran on a worker pool should be removed from the registry """
+        pool = WorkerPool(2, "soak")
+        def spawnLinked():
+            p = ShortLivedProcess()
+            p.pool = pool
+            pid = p.start_linked()
+            p.stop()
+            return pid
+        try:
+            self.assertBoundedMemory(spawnLinked)
+        finally:
+            pool.shutdown()
+
+if __name__ == '__main__':
+    run_tests()
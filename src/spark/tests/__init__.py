@@ -3,6 +3,7 @@ __all__ = [
     "ProtocolTest",
     "MessagingTest",
     "IntegrationTest",
+    "SimulationTest",
     "IoTest",
     #"FileShareTest"
 ]
\ No newline at end of file
@@ -74,11 +74,17 @@ def assertMatch(pattern, o):
     if not match(pattern, o):
         raise AssertionError("Object %s should match the pattern %s, but doesn't"
             % (repr(o), repr(pattern)))
+    elif not compile_pattern(pattern)(o):
+        raise AssertionError("Object %s should match the compiled pattern %s, but doesn't"
+            % (repr(o), repr(pattern)))
 
 def assertNoMatch(pattern, o):
     if match(pattern, o):
         raise AssertionError("Object %s should not match the pattern %s, but does"
             % (repr(o), repr(pattern)))
+    elif compile_pattern(pattern)(o):
+        raise AssertionError("Object %s should not match the compiled pattern %s, but does"
+            % (repr(o), repr(pattern)))
 
 def testFilePath(fileName):
     return os.path.join(os.path.dirname(__file__), fileName)
\ No newline at end of file